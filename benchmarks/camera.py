@@ -0,0 +1,58 @@
+"""
+Camera capture benchmark of the jpg streamer.
+Compare the CPU usage and frame rate of the MJPEG forwarding path and
+of the decode and encode path. Run it on the Raspberry Pi:
+
+    python camera.py -width 1920 -height 1080
+"""
+
+import argparse
+import time
+
+from jpg_streamer import Video
+
+
+def run(video, duration, quality):
+    """Return the frames/s and CPU % of the full size stream frames."""
+    frames = 0
+    nbytes = 0
+    start = time.perf_counter()
+    cpu = time.process_time()
+    while time.perf_counter() - start < duration:
+        frame = video.read_video_frame()
+        nbytes += len(frame.jpeg(None, quality))
+        frames += 1
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu
+    return frames / elapsed, 100 * cpu / elapsed, nbytes / max(frames, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Camera capture benchmark.')
+    parser.add_argument('-width', metavar='WIDTH', type=int,
+                        default=1920, help='capture width (int)')
+    parser.add_argument('-height', metavar='HEIGHT', type=int,
+                        default=1080, help='capture height (int)')
+    parser.add_argument('-quality', metavar='QUALITY', type=int,
+                        default=95, help='jpg quality 1-100 of the encode '
+                                         'path (int)')
+    parser.add_argument('-duration', metavar='DURATION', type=float,
+                        default=10.0, help='seconds per path (float)')
+    args = parser.parse_args()
+    print("{:>8} {:>8} {:>8} {:>12}".format("path", "fps", "cpu %",
+                                            "bytes/frame"))
+    for mjpeg in (False, True):
+        video = Video(args.width, args.height, mjpeg=mjpeg)
+        if mjpeg and not video.mjpeg:
+            print("{:>8} not supported by the camera".format("mjpeg"))
+            continue
+        # The MJPEG frames are forwarded without a quality
+        fps, cpu, size = run(video, args.duration,
+                             None if mjpeg else args.quality)
+        video.cap.release()
+        print("{:>8} {:>8.1f} {:>8.0f} {:>12.0f}".format(
+            "mjpeg" if mjpeg else "encode", fps, cpu, size))
+
+
+if __name__ == '__main__':
+    main()
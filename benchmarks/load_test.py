@@ -0,0 +1,76 @@
+"""
+Load test for the RPi GPIO TCP server.
+Measure the aggregate command throughput as the number of concurrent
+clients grows. Run it against a running server:
+
+    python load_test.py -host <raspberry> -clients 1,2,4,8
+"""
+
+import argparse
+import socket
+import threading
+import time
+
+
+def client_loop(host, port, pin, duration, counts, index):
+    """Query one pin voltage in lock-step until duration elapsed."""
+    sock = socket.create_connection((host, port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    cmd = "{} READVOLTAGE;".format(pin).encode()
+    count = 0
+    end = time.perf_counter() + duration
+    try:
+        while time.perf_counter() < end:
+            sock.sendall(cmd)
+            if not sock.recv(1024):
+                break
+            count += 1
+    except ConnectionError:
+        # Refused by the server connection limit
+        pass
+    finally:
+        sock.close()
+    counts[index] = count
+
+
+def run(host, port, pin, clients, duration):
+    """Return the aggregate commands/s of a number of clients."""
+    counts = [0] * clients
+    threads = [threading.Thread(target=client_loop,
+                                args=(host, port, pin, duration, counts, i))
+               for i in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return sum(counts) / elapsed, counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='RPi GPIO server load test.')
+    parser.add_argument('-host', metavar='HOST', type=str,
+                        default='localhost', help='server host (str)')
+    parser.add_argument('-port', metavar='PORT', type=int,
+                        default=9788, help='server port number (int)')
+    parser.add_argument('-pin', metavar='PIN', type=int,
+                        default=3, help='pin to read (int)')
+    parser.add_argument('-clients', metavar='CLIENTS', type=str,
+                        default='1,2,4,8', help='client counts to test (str)')
+    parser.add_argument('-duration', metavar='DURATION', type=float,
+                        default=5.0, help='seconds per client count (float)')
+    args = parser.parse_args()
+    print("{:>8} {:>8} {:>12} {:>14}".format("clients", "served",
+                                             "commands/s", "per client/s"))
+    for clients in [int(c) for c in args.clients.split(",")]:
+        rate, counts = run(args.host, args.port, args.pin, clients,
+                           args.duration)
+        # Clients refused by the server connection limit get no reply
+        served = len([c for c in counts if c])
+        print("{:>8} {:>8} {:>12.0f} {:>14.0f}".format(
+            clients, served, rate, rate / max(served, 1)))
+
+
+if __name__ == '__main__':
+    main()
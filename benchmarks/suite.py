@@ -0,0 +1,139 @@
+"""
+Benchmark suite of the RPi GPIO server and the Raspberry client.
+Report the round trip latency percentiles and the commands/s of single,
+batched and multi-client workloads. Without -host, the suite starts a
+server with the GPIO simulator backend on localhost, so it runs off the
+Raspberry Pi. The batched latencies are the ones of whole batches.
+-nodelay both compares the workloads with and without TCP_NODELAY on
+the client side, run it once per server -nodelay setting:
+
+    python suite.py -latency 0.0001
+    python suite.py -host <raspberry> -nodelay both
+"""
+
+import argparse
+import threading
+import time
+
+from raspberry_pi.RPi import Raspberry
+
+PERCENTILES = (0.5, 0.9, 0.99)
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+def start_server(latency):
+    """Start a simulated server on a free port, return the port."""
+    import rpi_gpio_server
+    rpi_gpio_server.use_backend('sim', latency)
+    server = rpi_gpio_server.ThreadedServer(("localhost", 0),
+                                            rpi_gpio_server.TCP, 0)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server.server_address[1]
+
+
+def single(raspberry, pin, count):
+    """Return the times (s) and the number of lock-step reads."""
+    times = []
+    for _ in range(count):
+        start = time.perf_counter()
+        raspberry.readvoltage(pin)
+        times.append(time.perf_counter() - start)
+    return times, count
+
+
+def batched(raspberry, pin, count, size=50):
+    """Return the times (s) and the number of reads of pipelined batches."""
+    times = []
+    for _ in range(max(count // size, 1)):
+        start = time.perf_counter()
+        with raspberry.pipeline() as pipe:
+            for _ in range(size):
+                pipe.readvoltage(pin)
+            pipe.execute()
+        times.append(time.perf_counter() - start)
+    return times, len(times) * size
+
+
+def multi_client(host, port, protocol, pin, count, clients=4,
+                 nodelay=True):
+    """Return the times (s) and the number of reads of concurrent clients."""
+    results = [None] * clients
+
+    def client(index):
+        raspberry = Raspberry(host, protocol, port=port, nodelay=nodelay)
+        raspberry.connect_to_pi()
+        results[index] = single(raspberry, pin, count // clients)[0]
+        raspberry.disconnect_from_pi()
+
+    threads = [threading.Thread(target=client, args=(i,))
+               for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    times = [t for result in results for t in result]
+    return times, len(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='RPi GPIO benchmark suite.')
+    parser.add_argument('-host', metavar='HOST', type=str, default=None,
+                        help='server host, a simulated server if not set '
+                             '(str)')
+    parser.add_argument('-port', metavar='PORT', type=int,
+                        default=9788, help='server port number (int)')
+    parser.add_argument('-latency', metavar='LATENCY', type=float,
+                        default=0, help='simulator delay of the GPIO calls '
+                                        'in s (float)')
+    parser.add_argument('-pin', metavar='PIN', type=int,
+                        default=3, help='pin to read (int)')
+    parser.add_argument('-count', metavar='COUNT', type=int,
+                        default=2000, help='reads per workload (int)')
+    parser.add_argument('-clients', metavar='CLIENTS', type=int,
+                        default=4, help='clients of the multi-client '
+                                        'workload (int)')
+    parser.add_argument('-batch', metavar='BATCH', type=int,
+                        default=50, help='reads per batch (int)')
+    parser.add_argument('-nodelay', choices=['on', 'off', 'both'],
+                        default='on', help='TCP_NODELAY of the clients')
+    args = parser.parse_args()
+    host, port = args.host, args.port
+    if host is None:
+        host, port = "localhost", start_server(args.latency)
+    nodelays = {'on': [True], 'off': [False], 'both': [False, True]}
+    print("{:>8} {:>8} {:>8} {:>10} {:>10} {:>10} {:>12}".format(
+        "workload", "nodelay", "protocol", "p50 (ms)", "p90 (ms)",
+        "p99 (ms)", "commands/s"))
+    for nodelay in nodelays[args.nodelay]:
+        for protocol in (0, 2):
+            raspberry = Raspberry(host, protocol, port=port,
+                                  nodelay=nodelay)
+            raspberry.connect_to_pi()
+            workloads = [
+                ("single", lambda: single(raspberry, args.pin, args.count)),
+                ("batched", lambda: batched(raspberry, args.pin, args.count,
+                                            args.batch)),
+                ("multi", lambda: multi_client(host, port, protocol,
+                                               args.pin, args.count,
+                                               args.clients, nodelay)),
+            ]
+            for name, workload in workloads:
+                start = time.perf_counter()
+                times, commands = workload()
+                elapsed = time.perf_counter() - start
+                print("{:>8} {:>8} {:>8} {} {:>12.0f}".format(
+                    name, str(nodelay), raspberry.version,
+                    " ".join("{:>10.3f}".format(percentile(times, q) * 1e3)
+                             for q in PERCENTILES),
+                    commands / elapsed))
+            raspberry.disconnect_from_pi()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Raspberry Pi GPIO-control Tango device server in asyncio green mode.
+The pin attributes and the commands are served by an AsyncRaspberry
+client, so the network waits of concurrent requests overlap instead of
+blocking the event loop. The connection, the recovery and the edge
+events keep the blocking Raspberry client, run in threads.
+"""
+
+import asyncio
+import json
+import time
+from tango import DevState, EnsureOmniThread, GreenMode
+from tango.server import Device, attribute, command
+
+from .resource import catch_connection_error
+from .RaspberryPiIO import RaspberryPiIO
+from .RPi import AsyncRaspberry, PROTOCOL_VERSION
+
+
+class AsyncRaspberryPiIO(RaspberryPiIO):
+    green_mode = GreenMode.Asyncio
+
+    async def init_device(self):
+        await Device.init_device(self)
+        self._init_state()
+        options = self._connection_options()
+        port = options.pop('port')
+        # Negotiate request ids so that the concurrent queries overlap
+        self.aio = AsyncRaspberry(self.Host, PROTOCOL_VERSION, port=port,
+                                  **options)
+        if self.cache_dir:
+            self._start_from_cache()
+            return
+        await self._run_blocking(self._connect)
+        if self.get_state() != DevState.ON:
+            return
+        try:
+            await self.aio.connect_to_pi()
+        except OSError:
+            self.set_state(DevState.FAULT)
+            self.debug_stream('Unable to connect to Raspberry Pi TCP/IP'
+                              + ' server.')
+
+    async def delete_device(self):
+        await self.aio.disconnect_from_pi()
+        await self._run_blocking(self._close)
+
+    async def _run_blocking(self, method, *args):
+        """Run a method of the blocking client off the event loop."""
+        def run():
+            with EnsureOmniThread():
+                return method(*args)
+        return await asyncio.get_event_loop().run_in_executor(None, run)
+
+    async def always_executed_hook(self):
+        if self._needs_recovery():
+            await self._run_blocking(self._recover)
+
+    def _timings(self):
+        return self.aio.timings
+
+    async def read_attr_hardware(self, attr_list):
+        # The snapshot is refreshed by the first pin read of a request
+        pass
+
+    async def _read_pin(self, pin_number):
+        """Return (voltage, output) from a fresh snapshot, None otherwise."""
+        if self.snapshot_max_age <= 0:
+            return None
+        if time.time() - self._snapshot_time > self.snapshot_max_age:
+            self._snapshot = await self.aio.read_all(self.pins)
+            self._snapshot_time = time.time()
+        return self._snapshot.get(int(pin_number))
+
+    @catch_connection_error
+    async def read_pin_voltage(self, attr):
+        attr_name = attr.get_name()
+        pin_number = self._get_pin(attr_name)
+        cached = await self._read_pin(pin_number)
+        if cached is None:
+            voltage = await self.aio.readvoltage(pin_number)
+        else:
+            voltage = cached[0]
+        value = voltage ^ self.invert_voltage # XOR gate
+        attr.set_value(value)
+
+    @catch_connection_error
+    async def write_pin_voltage(self, attr):
+        w_value = attr.get_write_value() ^ self.invert_voltage # XOR gate
+        attr_name = attr.get_name()
+        pin_number = self._get_pin(attr_name)
+        self._invalidate_snapshot()
+        output = await self.aio.readoutput(pin_number)
+        if not output or output is None:
+            raise ValueError("Pin must be setup as an output first")
+        else:
+            request = await self.aio.setvoltage(pin_number, w_value)
+            if not request:
+                raise ValueError("Pin must be setup as an output first")
+
+    @catch_connection_error
+    async def read_pin_output(self, attr):
+        attr_name = attr.get_name()
+        pin_number = self._get_pin(attr_name)
+        cached = await self._read_pin(pin_number)
+        if cached is None:
+            value = await self.aio.readoutput(pin_number)
+        else:
+            value = cached[1]
+        attr.set_value(value)
+
+    @catch_connection_error
+    async def write_pin_output(self, attr):
+        w_value = attr.get_write_value()
+        attr_name = attr.get_name()
+        pin_number = self._get_pin(attr_name)
+        self._invalidate_snapshot()
+        await self.aio.setoutput(pin_number, w_value)
+        if await self.aio.readoutput(pin_number) != w_value:
+            # Edge detected pins are kept as inputs by the server
+            raise ValueError("Pin is subscribed or triggers a rule")
+
+    @catch_connection_error
+    async def read_output_word(self, attr):
+        values = await self.aio.read_all(self.output_word_pins)
+        attr.set_value(self._output_word(values))
+
+    @catch_connection_error
+    async def write_output_word(self, attr):
+        levels = self._output_levels(attr.get_write_value())
+        self._invalidate_snapshot()
+        if not await self.aio.write_pins(levels):
+            raise ValueError("Pins must be setup as outputs first")
+
+    @attribute(dtype=str,
+               doc="Server service times and queue depth (JSON), null "
+                   "with protocol_version 0")
+    @catch_connection_error
+    async def server_stats(self):
+        return json.dumps(await self.aio.read_stats())
+
+    @command(dtype_in=(float,),
+             doc_in="pin, width (us), [count, [period (us)]]")
+    @catch_connection_error
+    async def Pulse(self, args):
+        pin, width = int(args[0]), args[1]
+        count = int(args[2]) if len(args) > 2 else 1
+        period = args[3] if len(args) > 3 else None
+        self._invalidate_snapshot()
+        if not await self.aio.pulse(pin, width, count, period):
+            raise ValueError("Pin must be setup as an output first")
+
+    @command(dtype_in=(float,),
+             doc_in="pin, frequency (Hz, 0 stops), duty cycle (%)")
+    @catch_connection_error
+    async def SetPWM(self, args):
+        pin, frequency, duty = int(args[0]), args[1], args[2]
+        self._invalidate_snapshot()
+        if not await self.aio.pwm(pin, frequency, duty):
+            raise ValueError("Pin must be setup as an output first")
+
+    @command(dtype_in=(float,),
+             doc_in="rate (Hz), count, pins (up to 32) to sample")
+    @catch_connection_error
+    async def Sample(self, args):
+        rate, count = args[0], int(args[1])
+        pins = [int(p) for p in args[2:34]]
+        # The other requests are served while the server samples
+        samples = await self.aio.sample(pins, rate, count)
+        if samples is None:
+            raise ValueError("Sampling needs pins set up")
+        self._samples = samples
+        self._sample_pins = pins
+
+    @command(dtype_in=float,
+             doc_in="Server monotonic time, or the last -N seconds if "
+                    "negative")
+    @catch_connection_error
+    async def ReadHistory(self, since):
+        history = await self.aio.history(since)
+        if history is None:
+            raise ValueError("History needs a server with -history")
+        self._history = history.records
+
+    @command(dtype_in=str, doc_in="JSON list of interlock rules")
+    @catch_connection_error
+    async def UploadRules(self, rules):
+        if not await self.aio.upload_rules(json.loads(rules)):
+            raise ValueError("Invalid rules")
+
+    @command(dtype_out=str, doc_out="JSON rules and hits")
+    @catch_connection_error
+    async def ListRules(self):
+        return json.dumps(await self.aio.list_rules())
+
+    @command
+    @catch_connection_error
+    async def ArmRules(self):
+        await self.aio.arm_rules()
+
+    @attribute(dtype=(str,), max_dim_x=64, doc="Names of the rules")
+    @catch_connection_error
+    async def rule_names(self):
+        return [rule['name'] for rule in await self.aio.list_rules() or []]
+
+    @attribute(dtype=(int,), max_dim_x=64,
+               doc="Times each rule fired, see rule_names")
+    @catch_connection_error
+    async def rule_hits(self):
+        return [rule['hits'] for rule in await self.aio.list_rules() or []]
+
+    @command
+    @catch_connection_error
+    async def TurnOff(self):
+        self._invalidate_snapshot()
+        await self.aio.turnoff()
+        self.set_state(DevState.OFF)
+
+    @command
+    @catch_connection_error
+    async def ResetAll(self):
+        self._invalidate_snapshot()
+        await self.aio.resetall()
+
+
+def run(args=None, **kwargs):
+    kwargs.setdefault('green_mode', GreenMode.Asyncio)
+    return AsyncRaspberryPiIO.run_server(args, **kwargs)
+
+
+if __name__ == "__main__":
+    run()
@@ -5,19 +5,307 @@ Class has no Tango dependence.
 """
 
 
+import abc
+import asyncio
+import json
 import socket
+import struct
+import threading
+import time
+from collections import deque, namedtuple
+from contextlib import contextmanager
 
+try:
+    import numpy
+except ImportError:
+    # Samples are returned as lists
+    numpy = None
 
-class Raspberry:
+# Binary framing, must match rpi_gpio_server.
+# Version 0 is the legacy ";" separated text protocol.
+PROTOCOL_VERSION = 2
+# Frame headers: version, kind, [request id,] payload length
+HEADERS = {
+    1: struct.Struct("!BBI"),
+    2: struct.Struct("!BBII"),
+}
+KIND_TEXT = 0
+KIND_PINS = 1
+KIND_EVENT = 2
+KIND_SAMPLES = 3
+KIND_HISTORY = 4
+# Pins payload: pins, pins with a known voltage, voltages, outputs (bitmasks)
+PINS = struct.Struct("!QQQQ")
+# Event payload: pin, voltage, time stamp (seconds since the epoch)
+EVENT = struct.Struct("!BBd")
+# Samples payload: start time stamp, mean sampling period (s), count,
+# followed by one bit-plane per pin
+SAMPLES = struct.Struct("!ddI")
+# Levels of the sampled pins, data[i][j] is the level of the ith pin at
+# start + j * period
+Samples = namedtuple("Samples", ["start", "period", "data"])
+# History payload: server monotonic and epoch times, records count,
+# followed by the records: monotonic time stamp, pin, level
+HISTORY = struct.Struct("!ddI")
+RECORD = struct.Struct("!dBB")
+# Pin transitions recorded by the server. records are (epoch time stamp,
+# pin, level), now is the server monotonic time of the reply, to pass as
+# since to get the next records
+PinHistory = namedtuple("PinHistory", ["now", "records"])
+# Time to wait for an old server to (not) answer the negotiation
+NEGOTIATION_TIMEOUT = 1.0
 
-    def __init__(self, host):
+
+def set_socket_options(sock, nodelay=True, keepalive_idle=0,
+                       keepalive_interval=5, keepalive_count=3):
+    """Disable Nagle and enable TCP keepalive (when keepalive_idle > 0)."""
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(nodelay))
+    if keepalive_idle <= 0:
+        return
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    # Linux only options
+    if hasattr(socket, "TCP_KEEPIDLE"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE,
+                        int(keepalive_idle))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL,
+                        int(keepalive_interval))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT,
+                        int(keepalive_count))
+
+
+def pack_command(cmd, version, request_id=0):
+    """Return the bytes sending a command with a protocol version."""
+    if not version:
+        return (cmd + ";").encode()
+    data = cmd.encode()
+    if version >= 2:
+        header = HEADERS[2].pack(version, KIND_TEXT, request_id, len(data))
+    else:
+        header = HEADERS[1].pack(version, KIND_TEXT, len(data))
+    return header + data
+
+
+def unpack_event(payload):
+    pin, voltage, timestamp = EVENT.unpack(payload)
+    return pin, bool(voltage), timestamp
+
+
+class Connection:
+    """One socket to the TCP server and its protocol state."""
+
+    def __init__(self, host, port, protocol=0, connect_timeout=None,
+                 timeout=None, **options):
         self.host = host
-        self.port = 9788
+        self.port = port
+        # Requested protocol version, the negotiated one is self.version
+        self.protocol = protocol
+        # Timeouts in seconds (None blocks) and set_socket_options options
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+        self.options = options
+        self.version = 0
+        self.buffer = b""
+        # Last request id and replies received for other requests
+        self.request_id = 0
+        self.replies = {}
+        # Edge events (pin, voltage, timestamp) received while querying
+        self.events = deque()
         # Create a TCP socket
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
-    def connect_to_pi(self):
+    def connect(self):
+        self.open()
+        if self.protocol:
+            self.negotiate(self.protocol)
+
+    def open(self):
+        self.sock.settimeout(self.connect_timeout)
         self.sock.connect((self.host, self.port))
+        self.sock.settimeout(self.timeout)
+        set_socket_options(self.sock, **self.options)
+
+    def negotiate(self, version):
+        """Switch the connection to the binary framing.
+
+        Servers not knowing the PROTOCOL command never reply, the
+        connection is then re-opened with the legacy text protocol: a
+        slow server could still switch to the framing and reply late.
+        """
+        self.sock.settimeout(NEGOTIATION_TIMEOUT)
+        try:
+            self.sendall(str(version) + " PROTOCOL")
+            self.version = int(self.recv_reply())
+        except socket.timeout:
+            self.close()
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.buffer = b""
+            self.version = 0
+            self.open()
+        else:
+            self.sock.settimeout(self.timeout)
+
+    def frame(self, cmd):
+        """Return the request id and the bytes to send for a command."""
+        if self.version >= 2:
+            self.request_id = self.request_id % 0xffffffff + 1
+        return self.request_id, pack_command(cmd, self.version,
+                                             self.request_id)
+
+    def sendall(self, cmd):
+        request_id, data = self.frame(cmd)
+        self.sock.sendall(data)
+        return request_id
+
+    @contextmanager
+    def extended_timeout(self, duration):
+        """Add duration (s) to the timeout, for slow replies."""
+        if not duration or self.timeout is None:
+            yield
+            return
+        self.sock.settimeout(self.timeout + duration)
+        try:
+            yield
+        finally:
+            self.sock.settimeout(self.timeout)
+
+    def recv_exactly(self, size):
+        while len(self.buffer) < size:
+            data = self.sock.recv(4096)
+            if not data:
+                raise ConnectionError("Connection closed by the server")
+            self.buffer += data
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def recv_frame(self, request_id=0):
+        """Return the kind and the payload of the reply to a request.
+
+        With protocol version 2 replies are matched by request id, the
+        ones received for other requests are kept for later.
+        """
+        if not self.version:
+            # Legacy replies are not delimited: one recv is one reply
+            data = self.sock.recv(1024)
+            if not data:
+                raise ConnectionError("Connection closed by the server")
+            return KIND_TEXT, data
+        if request_id in self.replies:
+            return self.replies.pop(request_id)
+        while True:
+            reply_id, kind, payload = self.read_frame()
+            if kind == KIND_EVENT:
+                self.events.append(unpack_event(payload))
+            elif self.version < 2 or reply_id == request_id:
+                return kind, payload
+            else:
+                self.replies[reply_id] = (kind, payload)
+
+    def read_frame(self):
+        """Return the request id, the kind and the payload of a frame."""
+        header = HEADERS[min(self.version, 2)]
+        fields = header.unpack(self.recv_exactly(header.size))
+        payload = self.recv_exactly(fields[-1])
+        if self.version < 2:
+            return 0, fields[1], payload
+        return fields[2], fields[1], payload
+
+    def recv_reply(self, request_id=0):
+        kind, payload = self.recv_frame(request_id)
+        return payload.decode()
+
+    def close(self):
+        try:
+            # Also wakes up a thread blocked in a recv
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+def action_name(cmd):
+    """Return the action of a command, e.g. READVOLTAGE for "3 READVOLTAGE"."""
+    words = cmd.split()
+    return words[min(1, len(words) - 1)] if words else ''
+
+
+class Timings:
+    """Round trip times of the last commands, per action.
+
+    Keeps the last size samples of every action and the number of
+    commands ended in each second of the last horizon seconds, for the
+    rate.
+    """
+
+    def __init__(self, size=1000, horizon=60):
+        self.size = size
+        self.horizon = horizon
+        self.lock = threading.Lock()
+        self.samples = {}
+        # [second, commands] of the last seconds, oldest first
+        self.counts = deque()
+
+    def add(self, action, duration, count=1):
+        second = int(time.monotonic())
+        with self.lock:
+            samples = self.samples.get(action)
+            if samples is None:
+                samples = self.samples[action] = deque(maxlen=self.size)
+            samples.append(duration)
+            if self.counts and self.counts[-1][0] == second:
+                self.counts[-1][1] += count
+            else:
+                self.counts.append([second, count])
+            while self.counts[0][0] <= second - self.horizon:
+                self.counts.popleft()
+
+    def percentile(self, q, action=None):
+        """Return the q (0-1) percentile (s) of an action or of all actions."""
+        with self.lock:
+            if action is None:
+                values = [v for s in self.samples.values() for v in s]
+            else:
+                values = list(self.samples.get(action, ()))
+        if not values:
+            return 0.0
+        values.sort()
+        return values[min(int(len(values) * q), len(values) - 1)]
+
+    def rate(self, window=10.0):
+        """Return the commands/s of the last window seconds (up to the
+        horizon), to the second."""
+        window = min(window, self.horizon)
+        start = time.monotonic() - window
+        with self.lock:
+            count = sum(n for second, n in self.counts if second >= start)
+        return count / window
+
+    def summary(self):
+        """Return {action: {count, p50, p99}}, times in s."""
+        with self.lock:
+            actions = {a: len(s) for a, s in self.samples.items()}
+        return {a: {"count": count,
+                    "p50": self.percentile(0.5, a),
+                    "p99": self.percentile(0.99, a)}
+                for a, count in actions.items()}
+
+
+class RaspberryCommands(abc.ABC):
+    """Commands of the TCP server and parsing of their replies.
+
+    Subclasses provide the transport: query(cmd, parse, duration)
+    returning the parsed reply and sendall(cmd) for commands without
+    reply. duration (s) is the time the server takes before replying,
+    added to the reply timeout.
+    """
+
+    @abc.abstractmethod
+    def sendall(self, cmd):
+        """Send a command without reply."""
+
+    @abc.abstractmethod
+    def query(self, cmd, parse=None, duration=0.0):
+        """Send a command, return its reply parsed by parse(kind,
+        payload), parse_bool by default."""
 
     def str_to_bool(self, s):
         if s == 'True':
@@ -27,23 +315,94 @@ class Raspberry:
         else:
             return None
 
-    def sendall(self, cmd):
-        self.sock.sendall((cmd + ";").encode())
+    def parse_bool(self, kind, payload):
+        return self.str_to_bool(payload.decode())
+
+    def parse_pins_list(self, kind, payload):
+        return [int(x) for x in payload.decode().split(",")]
+
+    def parse_json(self, kind, payload):
+        return json.loads(payload.decode())
+
+    def parse_pins(self, kind, payload):
+        if kind == KIND_PINS:
+            return self.unpack_pins(payload)
+        values = {}
+        for item in payload.decode().split(","):
+            if not item:
+                continue
+            pin, voltage, output = item.split(":")
+            values[int(pin)] = (self.str_to_bool(voltage),
+                                self.str_to_bool(output))
+        return values
 
-    def query(self, cmd):
-        self.sendall(cmd)
-        val = str(self.sock.recv(1024))
-        val = val.replace("'", "").replace("b", "")
-        bol = self.str_to_bool(val)
-        return bol
+    def parse_samples(self, kind, payload):
+        if kind != KIND_SAMPLES:
+            return None
+        start, period, count = SAMPLES.unpack_from(payload)
+        size = (count + 7) // 8
+        planes = [payload[i:i + size]
+                  for i in range(SAMPLES.size, len(payload), size)]
+        if numpy is not None:
+            data = numpy.array([numpy.unpackbits(
+                numpy.frombuffer(plane, numpy.uint8))[:count]
+                for plane in planes], dtype=bool)
+        else:
+            data = [[bool(plane[j >> 3] >> (7 - (j & 7)) & 1)
+                     for j in range(count)] for plane in planes]
+        return Samples(start, period, data)
+
+    def parse_history(self, kind, payload):
+        if kind != KIND_HISTORY:
+            return None
+        now, wall, count = HISTORY.unpack_from(payload)
+        # Server monotonic time to epoch
+        offset = wall - now
+        records = [(timestamp + offset, pin, bool(level))
+                   for timestamp, pin, level
+                   in RECORD.iter_unpack(payload[HISTORY.size:])]
+        return PinHistory(now, records)
 
     def read_pins_list(self):
-        self.sendall("READPINSLIST")
-        val = str(self.sock.recv(1024))
-        val = val.replace("'", "").replace("b", "")
-        values = [int(x) for x in val.split(",")]
+        return self.query("READPINSLIST", self.parse_pins_list)
+
+    def read_all(self, pins=None):
+        """Read voltage and output of several pins in one query.
+
+        Return a dict {pin: (voltage, output)}. All the pins known by the
+        server are read if pins is None.
+        """
+        if pins is None:
+            return self.query("READALL", self.parse_pins)
+        cmd = ",".join(str(p) for p in pins) + " READPINS"
+        return self.query(cmd, self.parse_pins)
+
+    def unpack_pins(self, payload):
+        pins, known, voltages, outputs = PINS.unpack(payload)
+        values = {}
+        for pin in range(64):
+            if not pins >> pin & 1:
+                continue
+            if known >> pin & 1:
+                voltage = bool(voltages >> pin & 1)
+            else:
+                voltage = None
+            values[pin] = (voltage, bool(outputs >> pin & 1))
         return values
 
+    def read_stats(self):
+        """Return the server statistics, see the STATS command.
+
+        Needs the binary framing, None otherwise.
+        """
+        return self.query("STATS", self.parse_json)
+
+    def read_capabilities(self):
+        """Return the server descriptor, see the CAPABILITIES command:
+        {"protocol": int, "pins": [int], "actions": [str], "history": int}.
+        """
+        return self.query("CAPABILITIES", self.parse_json)
+
     def readvoltage(self, pin):
         cmd = str(pin) + ' READVOLTAGE'
         return self.query(cmd)
@@ -58,15 +417,626 @@ class Raspberry:
 
     def setoutput(self, pin, value):
         data = str(pin) + ' SETOUTPUT ' + str(value)
-        self.sendall(data)
+        return self.sendall(data)
 
     def resetall(self):
         data = 'ALL RESET'
-        self.sendall(data)
+        return self.sendall(data)
 
     def turnoff(self):
         data = 'ALL OFF'
-        self.sendall(data)
+        return self.sendall(data)
+
+    def write_mask(self, mask, values):
+        """Write the output pins of mask at once, bit n is board pin n.
+
+        Return False, writing nothing, if a pin is not an output.
+        """
+        cmd = '{:#x} WRITEMASK {:#x}'.format(mask, values)
+        return self.query(cmd)
+
+    def write_pins(self, levels):
+        """Write several output pins at once from a {pin: level} dict."""
+        mask = values = 0
+        for pin, level in levels.items():
+            mask |= 1 << int(pin)
+            if level:
+                values |= 1 << int(pin)
+        return self.write_mask(mask, values)
+
+    def sample(self, pins, rate, count):
+        """Sample the levels of pins count times at rate Hz on the server.
+
+        Return Samples, with a (pins, count) boolean numpy array as data
+        (lists without numpy). None without binary framing or if a pin
+        can not be read.
+        """
+        cmd = '{} SAMPLE {} {}'.format(",".join(str(p) for p in pins),
+                                       rate, count)
+        # The reply comes once the samples are taken
+        duration = count / rate if rate > 0 else 0.0
+        return self.query(cmd, self.parse_samples, duration)
+
+    def history(self, since=-60.0, pins=None):
+        """Return the PinHistory of the edges and writes since a server
+        monotonic time, the last -since seconds if negative.
+
+        None without binary framing or if the server keeps no history.
+        """
+        cmd = '{!r} HISTORY'.format(float(since))
+        if pins is not None:
+            cmd += ' ' + ",".join(str(p) for p in pins)
+        return self.query(cmd, self.parse_history)
+
+    def upload_rules(self, rules):
+        """Replace the interlock rules evaluated by the server.
+
+        rules is a list of dicts, see rpi_gpio_server.Rule. Return False,
+        keeping the current rules, if one is not valid.
+        """
+        # ";" ends the text commands, escape it in the JSON strings
+        text = json.dumps(rules).replace(";", "\\u003b")
+        return self.query('ALL RULES ' + text)
+
+    def list_rules(self):
+        """Return the rules with their hits, None without binary framing."""
+        return self.query('ALL LISTRULES', self.parse_json)
+
+    def arm_rules(self):
+        """Re-arm the latched rules."""
+        return self.query('ALL ARMRULES')
+
+    def pulse(self, pin, width_us, count=1, period_us=None):
+        """Send count high pulses of width_us on an output pin.
+
+        The pulses are timed by the server, the period defaults to twice
+        the width.
+        """
+        cmd = '{} PULSE {} {}'.format(pin, width_us, count)
+        if period_us is not None:
+            cmd += ' {}'.format(period_us)
+        return self.query(cmd)
+
+    def pwm(self, pin, frequency, duty):
+        """Run a PWM of frequency Hz and duty cycle % on an output pin.
+
+        A frequency of 0 stops it.
+        """
+        cmd = '{} PWM {} {}'.format(pin, frequency, duty)
+        return self.query(cmd)
+
+    def subscribe(self, pin, edge='BOTH'):
+        """Ask for RISING, FALLING or BOTH edge events of an input pin.
+
+        Needs the binary framing, see listen().
+        """
+        cmd = str(pin) + ' SUBSCRIBE ' + edge
+        return self.query(cmd)
+
+    def unsubscribe(self, pin):
+        cmd = str(pin) + ' UNSUBSCRIBE'
+        return self.query(cmd)
+
+
+class Raspberry(RaspberryCommands):
+    """Client of the Raspberry Pi TCP server.
+
+    Queries use a pool of up to pool_size connections. A lost connection
+    is re-established on the next query, waiting an exponential backoff
+    between failed attempts: queries fail fast meanwhile.
+
+    connect_timeout and timeout (seconds, None blocks) and the
+    set_socket_options keywords are applied to every connection.
+    """
+
+    def __init__(self, host, protocol=0, port=9788, pool_size=1,
+                 backoff=0.1, max_backoff=30.0, **options):
+        self.host = host
+        self.port = port
+        self.protocol = protocol
+        self.options = options
+        # Protocol version negotiated by the last connection
+        self.version = 0
+        self.pool_size = pool_size
+        self.idle = []
+        self.connections = set()
+        # Connections being opened, counted in the pool size
+        self.opening = 0
+        # Incremented by disconnect_from_pi
+        self.generation = 0
+        self.condition = threading.Condition()
+        # Reconnection backoff
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.failures = 0
+        self.next_attempt = 0
+        # Time of the first failure and duration of the last outage (s)
+        self.down_since = None
+        self.recovery_time = 0.0
+        self.reconnections = 0
+        self.timings = Timings()
+
+    def connect_to_pi(self):
+        """Open a connection to the server and keep it in the pool."""
+        conn = self.acquire()
+        self.release(conn)
+
+    def open_connection(self):
+        """Connect, without holding the pool lock."""
+        with self.condition:
+            now = time.monotonic()
+            if now < self.next_attempt:
+                raise ConnectionRefusedError(
+                    "Reconnection to {} in {:.1f} s".format(
+                        self.host, self.next_attempt - now))
+        conn = Connection(self.host, self.port, self.protocol,
+                          **self.options)
+        try:
+            conn.connect()
+        except OSError:
+            conn.close()
+            with self.condition:
+                self.connection_lost()
+                self.failures += 1
+                delay = min(self.backoff * 2 ** (self.failures - 1),
+                            self.max_backoff)
+                self.next_attempt = time.monotonic() + delay
+            raise
+        with self.condition:
+            self.failures = 0
+            self.next_attempt = 0
+            if self.down_since is not None:
+                self.recovery_time = time.monotonic() - self.down_since
+                self.reconnections += 1
+                self.down_since = None
+            self.version = conn.version
+        return conn
+
+    def connection_lost(self):
+        if self.down_since is None:
+            self.down_since = time.monotonic()
+
+    def acquire(self):
+        with self.condition:
+            while not self.idle and (len(self.connections) + self.opening
+                                     >= self.pool_size):
+                self.condition.wait()
+            if self.idle:
+                return self.idle.pop()
+            # Reserve the slot, a slow connect must not block the pool
+            self.opening += 1
+            generation = self.generation
+        conn = None
+        try:
+            conn = self.open_connection()
+        finally:
+            with self.condition:
+                self.opening -= 1
+                stale = generation != self.generation
+                if conn is not None and not stale:
+                    self.connections.add(conn)
+                self.condition.notify()
+        if stale:
+            # Disconnected while connecting
+            conn.close()
+            raise ConnectionError("Disconnected from {}".format(self.host))
+        return conn
+
+    def release(self, conn):
+        with self.condition:
+            if conn in self.connections:
+                self.idle.append(conn)
+            self.condition.notify()
+
+    def discard(self, conn, lost=False):
+        with self.condition:
+            conn.close()
+            self.connections.discard(conn)
+            if lost:
+                self.connection_lost()
+            self.condition.notify()
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection from the pool."""
+        conn = self.acquire()
+        try:
+            yield conn
+        except OSError:
+            self.discard(conn, lost=True)
+            raise
+        except BaseException:
+            # Unknown protocol state, do not reuse the connection
+            self.discard(conn)
+            raise
+        self.release(conn)
+
+    def read_capabilities(self):
+        """Return the server descriptor, None if the server does not know
+        the CAPABILITIES command.
+
+        Such servers never reply: the reply is waited for at most
+        NEGOTIATION_TIMEOUT, then the connection is closed without being
+        counted as lost.
+        """
+        start = time.perf_counter()
+        conn = self.acquire()
+        timeout = NEGOTIATION_TIMEOUT
+        if conn.timeout is not None:
+            timeout = min(conn.timeout, timeout)
+        try:
+            request_id = conn.sendall("CAPABILITIES")
+            conn.sock.settimeout(timeout)
+            try:
+                kind, payload = conn.recv_frame(request_id)
+            finally:
+                conn.sock.settimeout(conn.timeout)
+        except socket.timeout:
+            # A late reply would be taken for the next one
+            self.discard(conn)
+            return None
+        except OSError:
+            self.discard(conn, lost=True)
+            raise
+        except BaseException:
+            self.discard(conn)
+            raise
+        self.release(conn)
+        self.timings.add("CAPABILITIES", time.perf_counter() - start)
+        return self.parse_json(kind, payload)
+
+    def sendall(self, cmd):
+        start = time.perf_counter()
+        with self.connection() as conn:
+            conn.sendall(cmd)
+        self.timings.add(action_name(cmd), time.perf_counter() - start)
+
+    def query(self, cmd, parse=None, duration=0.0):
+        start = time.perf_counter()
+        with self.connection() as conn:
+            request_id = conn.sendall(cmd)
+            with conn.extended_timeout(duration):
+                kind, payload = conn.recv_frame(request_id)
+        self.timings.add(action_name(cmd), time.perf_counter() - start)
+        if parse is None:
+            parse = self.parse_bool
+        return parse(kind, payload)
+
+    def pipeline(self):
+        """Return a Pipeline to send several commands in one go."""
+        return Pipeline(self)
+
+    def listen(self, callback):
+        """Call callback(pin, voltage, timestamp) for every edge event.
+
+        Block until the connection is closed. Subscriptions are made per
+        connection: use a Raspberry with a pool_size of 1 dedicated to
+        the events.
+        """
+        with self.connection() as conn:
+            while True:
+                while conn.events:
+                    callback(*conn.events.popleft())
+                reply_id, kind, payload = conn.read_frame()
+                if kind == KIND_EVENT:
+                    callback(*unpack_event(payload))
+                else:
+                    conn.replies[reply_id] = (kind, payload)
 
     def disconnect_from_pi(self):
-        self.sock.close()
+        with self.condition:
+            for conn in self.connections:
+                # Also wakes up a thread blocked in listen()
+                conn.close()
+            self.connections.clear()
+            self.idle = []
+            self.generation += 1
+            self.condition.notify_all()
+
+
+class Pipeline(RaspberryCommands):
+    """Queue Raspberry commands and send them without waiting for replies.
+
+    The commands return None on the pipeline. execute() sends all the
+    queued commands at once and returns the replies of the queries, in
+    order. With protocol version 2 many requests are in flight and the
+    replies are matched by request id. Used as a context manager, the
+    commands still queued are executed on a clean exit.
+    """
+
+    def __init__(self, raspberry):
+        self.raspberry = raspberry
+        self.commands = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None and self.commands:
+            self.execute()
+        self.commands = []
+
+    def sendall(self, cmd):
+        self.commands.append((cmd, None, 0.0))
+
+    def query(self, cmd, parse=None, duration=0.0):
+        if parse is None:
+            parse = self.parse_bool
+        self.commands.append((cmd, parse, duration))
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        start = time.perf_counter()
+        results = self.exchange(commands)
+        self.raspberry.timings.add('PIPELINE', time.perf_counter() - start,
+                                   len(commands))
+        return results
+
+    def exchange(self, commands):
+        results = []
+        with self.raspberry.connection() as conn:
+            if not conn.version:
+                # Legacy replies cannot be told apart, stay lock-step
+                for cmd, parse, duration in commands:
+                    request_id = conn.sendall(cmd)
+                    if parse is not None:
+                        with conn.extended_timeout(duration):
+                            kind, payload = conn.recv_frame(request_id)
+                        results.append(parse(kind, payload))
+                return results
+            frames = [conn.frame(cmd) + (parse,) for cmd, parse, _ in commands]
+            conn.sock.sendall(b"".join(data for _, data, _ in frames))
+            # The server handles the commands in order
+            duration = sum(duration for _, _, duration in commands)
+            with conn.extended_timeout(duration):
+                for request_id, data, parse in frames:
+                    if parse is not None:
+                        kind, payload = conn.recv_frame(request_id)
+                        results.append(parse(kind, payload))
+        return results
+
+
+class AsyncRaspberry(RaspberryCommands):
+    """asyncio client of the TCP server, with the Raspberry commands.
+
+    The commands are coroutines. With protocol version 2 concurrent
+    queries share the connection: their replies are dispatched by
+    request id. Older protocols serialize the queries. The connection
+    is re-opened by the next query after an error.
+    """
+
+    def __init__(self, host, protocol=PROTOCOL_VERSION, port=9788,
+                 connect_timeout=None, timeout=None, **options):
+        self.host = host
+        self.port = port
+        self.protocol = protocol
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+        self.options = options
+        self.version = 0
+        self.request_id = 0
+        self.reader = self.writer = None
+        self.reader_task = None
+        # Futures of the queries waiting for a reply, by request id
+        self.pending = {}
+        self.events = deque()
+        # Serializes the queries of a connection older than version 2
+        self.lock = None
+        # Serializes the connection attempts, created in the event loop
+        self.connect_lock = None
+        self.timings = Timings()
+
+    async def connect_to_pi(self):
+        """Open the connection if closed.
+
+        Concurrent calls share one connection attempt.
+        """
+        if self.connect_lock is None:
+            self.connect_lock = asyncio.Lock()
+        async with self.connect_lock:
+            if self.writer is None:
+                await self.open_connection()
+
+    async def open_connection(self):
+        await self.open_stream()
+        self.version = 0
+        if self.protocol:
+            try:
+                await self.negotiate(self.protocol)
+            except BaseException:
+                self.close()
+                raise
+        # Published once ready for the queries
+        self.lock = asyncio.Lock()
+        if self.version >= 2:
+            self.reader_task = asyncio.ensure_future(self.read_replies())
+
+    async def open_stream(self):
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port),
+            self.connect_timeout)
+        set_socket_options(writer.get_extra_info("socket"), **self.options)
+        self.reader, self.writer = reader, writer
+
+    async def negotiate(self, version):
+        """See Connection.negotiate."""
+        self.writer.write(pack_command(str(version) + " PROTOCOL", 0))
+        try:
+            data = await asyncio.wait_for(self.reader.read(1024),
+                                          NEGOTIATION_TIMEOUT)
+            self.version = int(data.decode())
+        except asyncio.TimeoutError:
+            self.close()
+            self.version = 0
+            await self.open_stream()
+
+    async def read_frame(self):
+        header = HEADERS[min(self.version, 2)]
+        fields = header.unpack(await self.reader.readexactly(header.size))
+        payload = await self.reader.readexactly(fields[-1])
+        if self.version < 2:
+            return 0, fields[1], payload
+        return fields[2], fields[1], payload
+
+    async def read_replies(self):
+        """Dispatch the replies to the pending queries (version 2)."""
+        try:
+            while True:
+                request_id, kind, payload = await self.read_frame()
+                if kind == KIND_EVENT:
+                    self.events.append(unpack_event(payload))
+                    continue
+                future = self.pending.pop(request_id, None)
+                if future is not None and not future.done():
+                    future.set_result((kind, payload))
+        except (OSError, asyncio.IncompleteReadError):
+            error = ConnectionError("Connection closed by the server")
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(error)
+        self.pending.clear()
+        self.close()
+
+    async def exchange(self, cmd, reply, duration=0.0):
+        """Send a command, return the kind and payload of its reply."""
+        timeout = self.timeout
+        if timeout is not None:
+            # The server replies after duration (s)
+            timeout += duration
+        await self.connect_to_pi()
+        writer, lock = self.writer, self.lock
+        if writer is None:
+            raise ConnectionError("Connection to {} closed".format(self.host))
+        if self.version >= 2:
+            self.request_id = request_id = self.request_id % 0xffffffff + 1
+            writer.write(pack_command(cmd, 2, request_id))
+            if not reply:
+                await writer.drain()
+                return None
+            future = asyncio.get_event_loop().create_future()
+            self.pending[request_id] = future
+            try:
+                await writer.drain()
+                return await asyncio.wait_for(future, timeout)
+            finally:
+                self.pending.pop(request_id, None)
+        async with lock:
+            if self.writer is not writer:
+                # Closed after an error of the query holding the lock
+                raise ConnectionError("Connection to {} closed".format(
+                    self.host))
+            writer.write(pack_command(cmd, self.version))
+            await writer.drain()
+            if not reply:
+                return None
+            if self.version:
+                while True:
+                    _, kind, payload = await asyncio.wait_for(
+                        self.read_frame(), timeout)
+                    if kind != KIND_EVENT:
+                        return kind, payload
+                    self.events.append(unpack_event(payload))
+            data = await asyncio.wait_for(self.reader.read(1024),
+                                          timeout)
+            if not data:
+                raise ConnectionError("Connection closed by the server")
+            return KIND_TEXT, data
+
+    async def request(self, cmd, reply, duration=0.0):
+        start = time.perf_counter()
+        try:
+            result = await self.exchange(cmd, reply, duration)
+            self.timings.add(action_name(cmd), time.perf_counter() - start)
+            return result
+        except asyncio.TimeoutError:
+            self.close()
+            raise TimeoutError("No reply from {}".format(self.host))
+        except (OSError, asyncio.IncompleteReadError) as error:
+            self.close()
+            raise ConnectionError(str(error))
+
+    async def sendall(self, cmd):
+        await self.request(cmd, False)
+
+    async def query(self, cmd, parse=None, duration=0.0):
+        kind, payload = await self.request(cmd, True, duration)
+        if parse is None:
+            parse = self.parse_bool
+        return parse(kind, payload)
+
+    def close(self):
+        if self.reader_task is not None:
+            if self.reader_task is not asyncio.current_task():
+                self.reader_task.cancel()
+            self.reader_task = None
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    async def disconnect_from_pi(self):
+        self.close()
+
+
+class RaspberryFleet:
+    """Drive the TCP servers of many Raspberry Pis concurrently.
+
+    One AsyncRaspberry per host, the queries of all hosts are awaited
+    together: a fleet wide read costs about one round trip. A host that
+    failed is skipped for an exponential backoff, so that it does not
+    slow down the others.
+    """
+
+    def __init__(self, hosts, protocol=PROTOCOL_VERSION, port=9788,
+                 backoff=0.1, max_backoff=30.0, **options):
+        self.raspberries = {host: AsyncRaspberry(host, protocol, port,
+                                                 **options)
+                            for host in hosts}
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        # {host: (failures, time of the next attempt)}
+        self.failures = {}
+
+    async def call(self, host, method, *args):
+        """Call a coroutine method of the client of a host."""
+        failures, next_attempt = self.failures.get(host, (0, 0))
+        if time.monotonic() < next_attempt:
+            raise ConnectionRefusedError("{} is down, retrying later"
+                                         .format(host))
+        try:
+            result = await getattr(self.raspberries[host], method)(*args)
+        except OSError:
+            delay = min(self.backoff * 2 ** failures, self.max_backoff)
+            self.failures[host] = (failures + 1, time.monotonic() + delay)
+            raise
+        self.failures.pop(host, None)
+        return result
+
+    async def gather(self, method, *args, hosts=None):
+        """Call a method on the hosts (default all) concurrently.
+
+        Return {host: result}, the result is the exception of a failed
+        host.
+        """
+        if hosts is None:
+            hosts = list(self.raspberries)
+        results = await asyncio.gather(
+            *(self.call(host, method, *args) for host in hosts),
+            return_exceptions=True)
+        return dict(zip(hosts, results))
+
+    async def connect(self):
+        """Connect to the hosts not connected yet."""
+        hosts = [host for host, raspberry in self.raspberries.items()
+                 if raspberry.writer is None]
+        return await self.gather('connect_to_pi', hosts=hosts)
+
+    async def read_all(self, pins=None):
+        """Return {host: {pin: (voltage, output)} or exception}."""
+        return await self.gather('read_all', pins)
+
+    def online(self, host):
+        return (self.raspberries[host].writer is not None
+                and host not in self.failures)
+
+    async def close(self):
+        await self.gather('disconnect_from_pi')
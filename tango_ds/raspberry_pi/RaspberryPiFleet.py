@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Tango device server aggregating the GPIO of many Raspberry Pis.
+The TCP servers of the Pis are driven concurrently by a RaspberryFleet
+client in asyncio green mode: the bulk reads of all the hosts overlap,
+so a snapshot of the whole fleet costs about one round trip instead of
+one per Pi. The attributes are keyed by host.
+"""
+
+import asyncio
+import json
+import time
+from tango import AttrQuality, DevState, GreenMode
+from tango.server import Device, attribute, command, device_property
+
+from .RPi import RaspberryFleet, PROTOCOL_VERSION
+
+
+class RaspberryPiFleet(Device):
+    green_mode = GreenMode.Asyncio
+
+    Hosts = device_property(dtype=(str,))
+    Port = device_property(dtype=int, default_value=9788)
+    # Pins read on every host, all the pins of each host if empty
+    pins = device_property(dtype=(int,), default_value=[])
+    # Socket timeouts (s) of each host, 0 blocks forever
+    connect_timeout = device_property(dtype=float, default_value=2.0)
+    read_timeout = device_property(dtype=float, default_value=2.0)
+    # Max age (s) of the fleet snapshot shared by the attributes
+    snapshot_max_age = device_property(dtype=float, default_value=0.5)
+    # Max delay (s) between the connection attempts to a host that is down
+    max_backoff = device_property(dtype=float, default_value=30.0)
+
+    async def init_device(self):
+        await Device.init_device(self)
+        self.fleet = RaspberryFleet(
+            self.Hosts, PROTOCOL_VERSION, port=self.Port,
+            max_backoff=self.max_backoff,
+            connect_timeout=self.connect_timeout or None,
+            timeout=self.read_timeout or None)
+        # {host: {pin: (voltage, output)} or exception}
+        self._snapshot = {}
+        self._snapshot_time = 0
+        self._snapshot_duration = 0.0
+        self._refresh_lock = asyncio.Lock()
+        await self.fleet.connect()
+        self._update_state()
+
+    async def delete_device(self):
+        await self.fleet.close()
+
+    def _online_count(self):
+        return sum(self.fleet.online(host) for host in self.Hosts)
+
+    def _quality(self):
+        if self._online_count() == len(self.Hosts):
+            return AttrQuality.ATTR_VALID
+        return AttrQuality.ATTR_INVALID
+
+    def _update_state(self):
+        online = self._online_count()
+        if online == len(self.Hosts):
+            self.set_state(DevState.ON)
+        elif online:
+            self.set_state(DevState.ALARM)
+        else:
+            self.set_state(DevState.FAULT)
+        self.set_status("{}/{} Raspberry Pis online".format(
+            online, len(self.Hosts)))
+
+    async def _refresh(self):
+        """Return the fleet snapshot, read again if too old."""
+        async with self._refresh_lock:
+            # Concurrent requests share the snapshot of the first one
+            if time.time() - self._snapshot_time > self.snapshot_max_age:
+                start = time.perf_counter()
+                self._snapshot = await self.fleet.read_all(
+                    self.pins or None)
+                self._snapshot_duration = time.perf_counter() - start
+                self._snapshot_time = time.time()
+                self._update_state()
+        return self._snapshot
+
+    def _columns(self, snapshot):
+        """Return the pins of the image columns: the pins property, or
+        the pins of all the hosts if empty."""
+        if self.pins:
+            return list(self.pins)
+        pins = set()
+        for values in snapshot.values():
+            if not isinstance(values, Exception):
+                pins.update(values)
+        return sorted(pins)
+
+    def _pin_image(self, snapshot, index):
+        """Return the hosts x pins image of a field of the snapshot."""
+        columns = self._columns(snapshot)
+        image = []
+        for host in self.Hosts:
+            pins = snapshot.get(host)
+            if isinstance(pins, Exception):
+                pins = {}
+            image.append([bool(pins.get(pin, (None, None))[index])
+                          for pin in columns])
+        return image
+
+    @attribute(dtype=(str,), max_dim_x=1024,
+               doc="Hosts of the fleet, order of the spectrum attributes")
+    def hosts(self):
+        return self.Hosts
+
+    @attribute(dtype=(bool,), max_dim_x=1024,
+               doc="Connection state of each host")
+    def online(self):
+        return [self.fleet.online(host) for host in self.Hosts]
+
+    @attribute(dtype=int, doc="Number of hosts online")
+    def online_count(self):
+        return self._online_count()
+
+    @attribute(dtype=str,
+               doc="Pins of every host (JSON), {host: {pin: [voltage, "
+                   "output]}} or {host: {\"error\": message}}")
+    async def snapshot(self):
+        snapshot = await self._refresh()
+        result = {}
+        for host in self.Hosts:
+            pins = snapshot.get(host)
+            if isinstance(pins, Exception):
+                result[host] = {"error": str(pins) or type(pins).__name__}
+            else:
+                result[host] = {str(pin): list(value)
+                                for pin, value in (pins or {}).items()}
+        return json.dumps(result)
+
+    @attribute(dtype=(int,), max_dim_x=64,
+               doc="Pins of the columns of the voltages and outputs")
+    async def columns(self):
+        return self._columns(await self._refresh())
+
+    @attribute(dtype=((bool,),), max_dim_x=64, max_dim_y=1024,
+               doc="Voltages of the pins (columns) of each host (rows), "
+                   "invalid if a host is offline")
+    async def voltages(self):
+        snapshot = await self._refresh()
+        return self._pin_image(snapshot, 0), time.time(), self._quality()
+
+    @attribute(dtype=((bool,),), max_dim_x=64, max_dim_y=1024,
+               doc="Output setup of the pins (columns) of each host "
+                   "(rows), invalid if a host is offline")
+    async def outputs(self):
+        snapshot = await self._refresh()
+        return self._pin_image(snapshot, 1), time.time(), self._quality()
+
+    @attribute(dtype=float, unit="s",
+               doc="Duration of the last fleet snapshot")
+    def snapshot_time(self):
+        return self._snapshot_duration
+
+    @command
+    async def Reconnect(self):
+        """Reconnect to the hosts that are down, without backoff."""
+        self.fleet.failures.clear()
+        await self.fleet.connect()
+        self._snapshot_time = 0
+        self._update_state()
+
+
+def run(args=None, **kwargs):
+    kwargs.setdefault('green_mode', GreenMode.Asyncio)
+    return RaspberryPiFleet.run_server(args, **kwargs)
+
+
+if __name__ == "__main__":
+    run()
@@ -6,13 +6,21 @@ Raspberry Pi GPIO-control Tango device server and http camera stream.
 KITS 2018-05-31.
 """
 
+import json
+import numpy
+import os
 import re
 import socket
-from tango import AttReqType, CmdArgType, Attr, READ_WRITE, DevState
-from tango.server import Device, command, device_property
+import threading
+import time
+import urllib.error
+import urllib.request
+from tango import (AttReqType, AttrQuality, CmdArgType, Attr, READ_WRITE,
+                   DevFailed, DevState, EnsureOmniThread)
+from tango.server import Device, attribute, command, device_property
 
 from .resource import catch_connection_error
-from .RPi import Raspberry
+from .RPi import Raspberry, PROTOCOL_VERSION
 
 
 class RaspberryPiIO(Device):
@@ -20,6 +28,38 @@ class RaspberryPiIO(Device):
     Port = device_property(dtype=int, default_value=9788)
     pins = device_property(dtype=(int,))
     invert_voltage = device_property(dtype=bool, default_value=False)
+    # Max age (s) of the pins snapshot shared by the attributes read in one
+    # request. 0 disables the snapshot (needs a server supporting READALL)
+    snapshot_max_age = device_property(dtype=float, default_value=0.0)
+    # 0: legacy text protocol, 1: binary framing, 2: framing with request
+    # ids. The version is negotiated with the server on connection
+    protocol_version = device_property(dtype=int, default_value=0)
+    # Socket timeouts (s), 0 blocks forever
+    connect_timeout = device_property(dtype=float, default_value=2.0)
+    read_timeout = device_property(dtype=float, default_value=2.0)
+    # Disable Nagle's algorithm for the small command/reply packets
+    tcp_nodelay = device_property(dtype=bool, default_value=True)
+    # TCP keepalive probes (s), keepalive_idle 0 disables them
+    keepalive_idle = device_property(dtype=float, default_value=10.0)
+    keepalive_interval = device_property(dtype=float, default_value=5.0)
+    keepalive_count = device_property(dtype=int, default_value=3)
+    # Push change events of the pinN_voltage attributes on the pin edges
+    # pushed by the server (needs a server supporting the binary framing)
+    edge_events = device_property(dtype=bool, default_value=False)
+    # Pins of the output_word attribute, least significant bit first.
+    # The attribute is not created if empty
+    output_word_pins = device_property(dtype=(int,), default_value=[])
+    # Poll period (s) of the camera snapshots of the jpg streamer running
+    # on the Pi, 0 disables the camera_jpeg attribute
+    camera_period = device_property(dtype=float, default_value=0.0)
+    camera_port = device_property(dtype=int, default_value=5000)
+    # Width of the downscaled snapshots, 0 for the full size
+    camera_width = device_property(dtype=int, default_value=0)
+    # Directory of the cached pins and capabilities of each server. If set,
+    # the attributes are created from the cache and the device connects
+    # in the background, the pins are reconciled once connected. Empty:
+    # the device connects and reads the pins in init_device
+    cache_dir = device_property(dtype=str, default_value="")
 
     def _get_pin(self, attr_name):
         m = re.search('\s*(?P<pin>[\d]+)\s*', attr_name)
@@ -34,70 +74,396 @@ class RaspberryPiIO(Device):
 
         return pin_number
 
+    def _cached_pin(self, pin_number):
+        """Return (voltage, output) from a fresh snapshot, None otherwise."""
+        if self.snapshot_max_age <= 0:
+            return None
+        if time.time() - self._snapshot_time > self.snapshot_max_age:
+            return None
+        return self._snapshot.get(int(pin_number))
+
+    def _invalidate_snapshot(self):
+        self._snapshot_time = 0
+
+    def _connection_options(self):
+        return dict(port=self.Port,
+                    connect_timeout=self.connect_timeout or None,
+                    timeout=self.read_timeout or None,
+                    nodelay=self.tcp_nodelay,
+                    keepalive_idle=self.keepalive_idle,
+                    keepalive_interval=self.keepalive_interval,
+                    keepalive_count=self.keepalive_count)
+
     def init_device(self):
         Device.init_device(self)
-        self.raspberry = Raspberry(self.Host)
+        self._init_state()
+        if self.cache_dir:
+            self._start_from_cache()
+            return
+        self._connect()
+
+    def _init_state(self):
+        """Create the client and the device state from the properties."""
+        self.raspberry = Raspberry(self.Host, self.protocol_version,
+                                   **self._connection_options())
+        self._snapshot = {}
+        self._snapshot_time = 0
+        self.edge_listener = None
+        self.edge_thread = None
+        self.camera_stop = None
+        self._samples = None
+        self._sample_pins = []
+        self._history = []
+        self._camera_frame = None
+        self._camera_count = 0
+        if self.camera_period > 0:
+            # Events pushed by the device, no detection on polling
+            self.set_change_event("camera_jpeg", True, False)
+            self.set_data_ready_event("camera_jpeg", True)
+            self.start_camera()
 
+        self._capabilities = None
+        # Pins of the property, self.pins keeps the ones of the server
+        self._wanted_pins = list(self.pins)
+        self._pins_lock = threading.RLock()
+        self._attributes_created = False
+        self._pins_reconciled = False
+
+    def _connect(self):
+        """Connect and read the pins of the server, FAULT if unreachable."""
         # No error decorator for the init function
         try:
             self.raspberry.connect_to_pi()
             self.set_state(DevState.ON)
             # Get the list of pins from the device
-            available_pins = set(self.raspberry.read_pins_list())
-
-            # Convert self.pins to a set for efficient lookup
-            current_pins = set(self.pins)
+            self._reconcile_pins(self.raspberry.read_pins_list())
 
-            # Find pins to remove
-            pins_to_remove = ', '.join(map(str, current_pins - available_pins))
-
-            # Remove pins not present in device_pins
-            self.pins = list(current_pins & available_pins)
-
-            if pins_to_remove:
-                msg = "Removed pins: {}".format(pins_to_remove)
-                self.debug_stream(msg)
+            if self.edge_events:
+                self.start_edge_events()
 
         except (BrokenPipeError, ConnectionRefusedError,
                 ConnectionError, socket.timeout,
-                TimeoutError) as connectionerror:
+                TimeoutError, OSError) as connectionerror:
             self.set_state(DevState.FAULT)
             self.debug_stream('Unable to connect to Raspberry Pi TCP/IP'
                               + ' server.')
 
+    def _cache_path(self):
+        name = "{}_{}.json".format(self.Host, self.Port)
+        return os.path.join(self.cache_dir, name)
+
+    def _load_cache(self):
+        try:
+            with open(self._cache_path()) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(cache, dict) or "pins" not in cache:
+            return None
+        return cache
+
+    def _save_cache(self, capabilities):
+        path = self._cache_path()
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # Replace atomically, the other device servers read it
+            with open(path + ".tmp", "w") as f:
+                json.dump(capabilities, f)
+            os.replace(path + ".tmp", path)
+        except OSError:
+            self.warn_stream('Unable to write {}'.format(path))
+
+    def _start_from_cache(self):
+        """Create the attributes from the cache, connect in a thread."""
+        cache = self._load_cache()
+        if cache is not None:
+            self._capabilities = cache
+            self.pins = [pin for pin in self.pins if pin in cache["pins"]]
+        self.set_state(DevState.INIT)
+        self.set_status('Connecting to {}'.format(self.Host))
+        thread = threading.Thread(target=self._connect_in_background)
+        thread.daemon = True
+        thread.start()
+
+    def _connect_in_background(self):
+        with EnsureOmniThread():
+            try:
+                self.raspberry.connect_to_pi()
+                self._read_capabilities()
+            except OSError:
+                self.set_state(DevState.FAULT)
+                self.set_status('Unable to connect to {}'.format(self.Host))
+                self.debug_stream('Unable to connect to Raspberry Pi TCP/IP'
+                                  + ' server.')
+                return
+            except ValueError as error:
+                # Retried from FAULT by always_executed_hook
+                self.set_state(DevState.FAULT)
+                self.set_status(str(error))
+                self.error_stream(str(error))
+                return
+            self.set_state(DevState.ON)
+            self.set_status('Connected to {}'.format(self.Host))
+            if self.edge_events:
+                try:
+                    self.start_edge_events()
+                except OSError:
+                    self.debug_stream('Unable to start edge events.')
+
+    def _read_capabilities(self):
+        """Read the capabilities of the server, cache them and reconcile
+        the pins. Servers without CAPABILITIES only give their pins.
+
+        Raise ValueError if the replies are invalid.
+        """
+        capabilities = self.raspberry.read_capabilities()
+        if capabilities is None:
+            capabilities = {"pins": self.raspberry.read_pins_list()}
+        try:
+            pins = [int(pin) for pin in capabilities["pins"]]
+        except (KeyError, TypeError) as error:
+            raise ValueError("Invalid capabilities of {}: {!r}".format(
+                self.Host, error))
+        self._capabilities = capabilities
+        if self.cache_dir:
+            self._save_cache(capabilities)
+        self._reconcile_pins(pins)
+
+    def _supports(self, action):
+        """Return False if the server is known not to support action."""
+        if not self._capabilities or "actions" not in self._capabilities:
+            return True
+        return action in self._capabilities["actions"]
+
+    def _reconcile_pins(self, available_pins):
+        """Keep the pins property pins available on the server, the pin
+        attributes already created are added or removed accordingly."""
+        with self._pins_lock:
+            self._pins_reconciled = True
+            available_pins = set(available_pins)
+            current_pins = set(self.pins)
+            self.pins = [pin for pin in self._wanted_pins
+                         if pin in available_pins]
+            removed = current_pins - available_pins
+            added = set(self.pins) - current_pins
+            if removed:
+                msg = "Removed pins: {}".format(
+                    ', '.join(map(str, sorted(removed))))
+                self.debug_stream(msg)
+            if not self._attributes_created:
+                return
+            for pin_number in removed:
+                self.remove_attribute("pin{}_voltage".format(pin_number))
+                self.remove_attribute("pin{}_output".format(pin_number))
+            for pin_number in added:
+                self._add_pin_attributes(pin_number)
+
+    def always_executed_hook(self):
+        if self._needs_recovery():
+            self._recover()
+
+    def _needs_recovery(self):
+        if self.raspberry is None:
+            return False
+        if self.get_state() == DevState.FAULT:
+            return True
+        return (self.edge_events and self.get_state() == DevState.ON
+                and not (self.edge_thread and self.edge_thread.is_alive()))
+
+    def _recover(self):
+        """Reconnect without Init and restart the edge events."""
+        # The Raspberry client delays the reconnection attempts with a
+        # backoff
+        if self.get_state() == DevState.FAULT:
+            try:
+                self.raspberry.connect_to_pi()
+                if self.cache_dir and not self._pins_reconciled:
+                    self._read_capabilities()
+            except OSError:
+                return
+            except ValueError as error:
+                self.set_status(str(error))
+                return
+            self.set_state(DevState.ON)
+            self.set_status('Connected to {}'.format(self.Host))
+            self.info_stream('Reconnected to Raspberry Pi TCP/IP server.')
+        if (self.edge_events and self.get_state() == DevState.ON
+                and not (self.edge_thread and self.edge_thread.is_alive())):
+            try:
+                self.start_edge_events()
+            except OSError:
+                self.debug_stream('Unable to restart edge events.')
+
     def delete_device(self):
+        self._close()
+
+    def _close(self):
+        self.stop_edge_events()
+        self.edge_listener = None
+        self.stop_camera()
         self.raspberry.disconnect_from_pi()
         self.raspberry = None
 
+    def start_edge_events(self):
+        self.stop_edge_events()
+        listener = self.edge_listener
+        if listener is None:
+            # Events are received on a dedicated connection, kept with its
+            # reconnection backoff until delete_device
+            options = self._connection_options()
+            # Waiting for events is not a timeout
+            options['timeout'] = None
+            listener = Raspberry(self.Host, PROTOCOL_VERSION, **options)
+            self.edge_listener = listener
+        listener.connect_to_pi()
+        if not listener.version:
+            listener.disconnect_from_pi()
+            self.warn_stream('Server does not support edge events')
+            self.edge_events = False
+            return
+        for pin in self.pins:
+            if not listener.subscribe(pin, 'BOTH'):
+                self.warn_stream('No edge events for pin {}'.format(pin))
+        thread = threading.Thread(target=self._listen_edges, args=(listener,))
+        thread.daemon = True
+        thread.start()
+        self.edge_thread = thread
+
+    def stop_edge_events(self):
+        if self.edge_listener is not None:
+            # Closing the connection ends the listening thread
+            self.edge_listener.disconnect_from_pi()
+
+    def _listen_edges(self, listener):
+        with EnsureOmniThread():
+            try:
+                listener.listen(self._push_edge)
+            except (ConnectionError, OSError):
+                self.debug_stream('Edge events connection closed.')
+
+    def _push_edge(self, pin, voltage, timestamp):
+        self._invalidate_snapshot()
+        value = voltage ^ self.invert_voltage # XOR gate
+        try:
+            self.push_change_event("pin{}_voltage".format(pin), value,
+                                   timestamp, AttrQuality.ATTR_VALID)
+        except DevFailed:
+            # Attribute not created yet
+            self.debug_stream('Edge of pin {} not pushed'.format(pin))
+
+    def start_camera(self):
+        self.stop_camera()
+        url = "http://{}:{}/snapshot.jpg".format(self.Host, self.camera_port)
+        if self.camera_width > 0:
+            url += "?width={}".format(self.camera_width)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._poll_camera, args=(url, stop))
+        thread.daemon = True
+        thread.start()
+        self.camera_stop = stop
+
+    def stop_camera(self):
+        if self.camera_stop is not None:
+            self.camera_stop.set()
+            self.camera_stop = None
+
+    def _poll_camera(self, url, stop):
+        etag = None
+        with EnsureOmniThread():
+            while not stop.is_set():
+                start = time.time()
+                try:
+                    etag = self._fetch_camera(url, etag)
+                except OSError:
+                    self.debug_stream('Unable to get a camera snapshot.')
+                stop.wait(max(0.0, self.camera_period - (time.time() - start)))
+
+    def _fetch_camera(self, url, etag):
+        """Get the snapshot if newer than etag, return its etag."""
+        request = urllib.request.Request(url)
+        if etag:
+            # The streamer replies 304 if the frame did not change
+            request.add_header("If-None-Match", etag)
+        try:
+            with urllib.request.urlopen(
+                    request, timeout=self.read_timeout or None) as response:
+                data = response.read()
+                etag = response.headers.get("ETag")
+        except urllib.error.HTTPError as error:
+            if error.code == 304:
+                return etag
+            raise
+        self._camera_frame = data
+        self._camera_count += 1
+        try:
+            self.push_change_event("camera_jpeg", "jpeg", data)
+            self.push_data_ready_event("camera_jpeg", self._camera_count)
+        except DevFailed:
+            self.debug_stream('Camera frame not pushed')
+        return etag
+
     def initialize_dynamic_attributes(self):
-        for pin_number in self.pins:
-            # Create attribute name
-            voltage_attrname = "pin{}_voltage".format(pin_number)
-            output_attrname = "pin{}_output".format(pin_number)
-            # Get tango type
-            tango_type = CmdArgType.DevBoolean
-            # Create attributes
-            voltage_attr = Attr(voltage_attrname,
-                                      tango_type, READ_WRITE)
-            output_attr = Attr(output_attrname,
-                                     tango_type, READ_WRITE)
-            # Add attribute and setup read/write/allowed method
-            self.add_attribute(
-                voltage_attr,
-                r_meth=self.read_pin_voltage,
-                w_meth=self.write_pin_voltage,
-                is_allo_meth=self.is_voltage_allowed)
+        with self._pins_lock:
+            self._attributes_created = True
+            for pin_number in self.pins:
+                self._add_pin_attributes(pin_number)
+        if self.output_word_pins and self._supports('WRITEMASK'):
+            # Parallel word written at once by the server
+            word_attr = Attr("output_word", CmdArgType.DevULong, READ_WRITE)
             self.add_attribute(
-                output_attr,
-                r_meth=self.read_pin_output,
-                w_meth=self.write_pin_output,
+                word_attr,
+                r_meth=self.read_output_word,
+                w_meth=self.write_output_word,
                 is_allo_meth=self.is_output_allowed)
 
+    def _add_pin_attributes(self, pin_number):
+        # Create attribute name
+        voltage_attrname = "pin{}_voltage".format(pin_number)
+        output_attrname = "pin{}_output".format(pin_number)
+        # Get tango type
+        tango_type = CmdArgType.DevBoolean
+        # Create attributes
+        voltage_attr = Attr(voltage_attrname, tango_type, READ_WRITE)
+        output_attr = Attr(output_attrname, tango_type, READ_WRITE)
+        if self.edge_events:
+            # Events pushed by the device, no detection on polling
+            voltage_attr.set_change_event(True, False)
+        # Add attribute and setup read/write/allowed method
+        self.add_attribute(
+            voltage_attr,
+            r_meth=self.read_pin_voltage,
+            w_meth=self.write_pin_voltage,
+            is_allo_meth=self.is_voltage_allowed)
+        self.add_attribute(
+            output_attr,
+            r_meth=self.read_pin_output,
+            w_meth=self.write_pin_output,
+            is_allo_meth=self.is_output_allowed)
+
+    @catch_connection_error
+    def read_attr_hardware(self, attr_list):
+        # Take one snapshot of all the pins for the whole request
+        if self.snapshot_max_age <= 0 or self.get_state() != DevState.ON:
+            return
+        if time.time() - self._snapshot_time <= self.snapshot_max_age:
+            return
+        multi_attr = self.get_device_attr()
+        names = [multi_attr.get_attr_by_ind(ind).get_name()
+                 for ind in attr_list]
+        if any(re.match(r'pin\d+_', name) for name in names):
+            self._snapshot = self.raspberry.read_all(self.pins)
+            self._snapshot_time = time.time()
+
     @catch_connection_error
     def read_pin_voltage(self, attr):
         attr_name = attr.get_name()
         pin_number = self._get_pin(attr_name)
-        value = self.raspberry.readvoltage(pin_number) ^ self.invert_voltage # XOR gate
+        cached = self._cached_pin(pin_number)
+        if cached is None:
+            voltage = self.raspberry.readvoltage(pin_number)
+        else:
+            voltage = cached[0]
+        value = voltage ^ self.invert_voltage # XOR gate
         attr.set_value(value)
 
     @catch_connection_error
@@ -105,6 +471,7 @@ class RaspberryPiIO(Device):
         w_value = attr.get_write_value() ^ self.invert_voltage # XOR gate
         attr_name = attr.get_name()
         pin_number = self._get_pin(attr_name)
+        self._invalidate_snapshot()
         output = self.raspberry.readoutput(pin_number)
         if not output or output is None:
             raise ValueError("Pin must be setup as an output first")
@@ -124,7 +491,11 @@ class RaspberryPiIO(Device):
     def read_pin_output(self, attr):
         attr_name = attr.get_name()
         pin_number = self._get_pin(attr_name)
-        value = self.raspberry.readoutput(pin_number)
+        cached = self._cached_pin(pin_number)
+        if cached is None:
+            value = self.raspberry.readoutput(pin_number)
+        else:
+            value = cached[1]
         attr.set_value(value)
 
     @catch_connection_error
@@ -132,13 +503,219 @@ class RaspberryPiIO(Device):
         w_value = attr.get_write_value()
         attr_name = attr.get_name()
         pin_number = self._get_pin(attr_name)
-        self.raspberry.setoutput(pin_number, w_value)
+        self._invalidate_snapshot()
+        # SETOUTPUT has no reply, read the direction back in the same
+        # round trip
+        with self.raspberry.pipeline() as pipe:
+            pipe.setoutput(pin_number, w_value)
+            pipe.readoutput(pin_number)
+            output, = pipe.execute()
+        if output != w_value:
+            # Edge detected pins are kept as inputs by the server
+            raise ValueError("Pin is subscribed or triggers a rule")
 
     def is_output_allowed(self, request):
         return self.get_state() == DevState.ON
 
+    def _output_word(self, values):
+        """Return the output word of {pin: (voltage, output)}."""
+        word = 0
+        for bit, pin in enumerate(self.output_word_pins):
+            voltage = values.get(pin, (None, None))[0]
+            if voltage is not None and voltage ^ self.invert_voltage:
+                word |= 1 << bit
+        return word
+
+    def _output_levels(self, word):
+        """Return the {pin: level} writing an output word."""
+        return {pin: bool(word >> bit & 1) ^ self.invert_voltage
+                for bit, pin in enumerate(self.output_word_pins)}
+
+    @catch_connection_error
+    def read_output_word(self, attr):
+        values = self.raspberry.read_all(self.output_word_pins)
+        attr.set_value(self._output_word(values))
+
+    @catch_connection_error
+    def write_output_word(self, attr):
+        levels = self._output_levels(attr.get_write_value())
+        self._invalidate_snapshot()
+        if not self.raspberry.write_pins(levels):
+            raise ValueError("Pins must be setup as outputs first")
+
+    @attribute(dtype=str,
+               doc="Capabilities of the server (JSON), from the cache "
+                   "until connected, see cache_dir")
+    def capabilities(self):
+        return json.dumps(self._capabilities)
+
+    @attribute(dtype=float, unit="s",
+               doc="Duration of the last connection outage")
+    def recovery_time(self):
+        return self.raspberry.recovery_time
+
+    @attribute(dtype=int, doc="Number of reconnections to the server")
+    def reconnections(self):
+        return self.raspberry.reconnections
+
+    def _timings(self):
+        """Return the Timings of the client serving the pins."""
+        return self.raspberry.timings
+
+    @attribute(dtype=float, unit="s",
+               doc="Median round trip time of the last commands")
+    def rtt_p50(self):
+        return self._timings().percentile(0.5)
+
+    @attribute(dtype=float, unit="s",
+               doc="99th percentile round trip time of the last commands")
+    def rtt_p99(self):
+        return self._timings().percentile(0.99)
+
+    @attribute(dtype=float, doc="Commands sent per second, last 10 s")
+    def commands_per_s(self):
+        return self._timings().rate()
+
+    @attribute(dtype=str,
+               doc="Server service times and queue depth (JSON), null "
+                   "with protocol_version 0")
+    @catch_connection_error
+    def server_stats(self):
+        return json.dumps(self.raspberry.read_stats())
+
+    @attribute(dtype=CmdArgType.DevEncoded,
+               doc="Last camera snapshot (jpeg), see camera_period")
+    def camera_jpeg(self):
+        if self._camera_frame is None:
+            raise ValueError("No camera frame")
+        return "jpeg", self._camera_frame
+
+    @command(dtype_in=(float,),
+             doc_in="pin, width (us), [count, [period (us)]]")
+    @catch_connection_error
+    def Pulse(self, args):
+        pin, width = int(args[0]), args[1]
+        count = int(args[2]) if len(args) > 2 else 1
+        period = args[3] if len(args) > 3 else None
+        self._invalidate_snapshot()
+        if not self.raspberry.pulse(pin, width, count, period):
+            raise ValueError("Pin must be setup as an output first")
+
+    def is_Pulse_allowed(self):
+        return self.get_state() == DevState.ON
+
+    @command(dtype_in=(float,),
+             doc_in="pin, frequency (Hz, 0 stops), duty cycle (%)")
+    @catch_connection_error
+    def SetPWM(self, args):
+        pin, frequency, duty = int(args[0]), args[1], args[2]
+        self._invalidate_snapshot()
+        if not self.raspberry.pwm(pin, frequency, duty):
+            raise ValueError("Pin must be setup as an output first")
+
+    def is_SetPWM_allowed(self):
+        return self.get_state() == DevState.ON
+
+    @command(dtype_in=(float,),
+             doc_in="rate (Hz), count, pins (up to 32) to sample")
+    @catch_connection_error
+    def Sample(self, args):
+        rate, count = args[0], int(args[1])
+        pins = [int(p) for p in args[2:34]]
+        samples = self.raspberry.sample(pins, rate, count)
+        if samples is None:
+            raise ValueError("Sampling needs protocol_version >= 1 and "
+                             "pins set up")
+        self._samples = samples
+        self._sample_pins = pins
+
+    def is_Sample_allowed(self):
+        return self.get_state() == DevState.ON
+
+    @attribute(dtype=(numpy.uint32,), max_dim_x=1000000,
+               doc="Last samples, bit i is the level of the ith sampled pin")
+    def sample_data(self):
+        if self._samples is None:
+            return numpy.zeros(0, numpy.uint32)
+        data = numpy.asarray(self._samples.data, dtype=numpy.uint32)
+        weights = numpy.left_shift(
+            numpy.uint32(1), numpy.arange(len(data), dtype=numpy.uint32))
+        return (data * weights[:, None]).sum(axis=0, dtype=numpy.uint32)
+
+    @attribute(dtype=float, unit="s", doc="Mean period of the last samples")
+    def sample_period(self):
+        return self._samples.period if self._samples is not None else 0.0
+
+    @attribute(dtype=(int,), max_dim_x=32, doc="Pins of the last samples")
+    def sample_pins(self):
+        return self._sample_pins
+
+    @command(dtype_in=float,
+             doc_in="Server monotonic time, or the last -N seconds if "
+                    "negative")
+    @catch_connection_error
+    def ReadHistory(self, since):
+        history = self.raspberry.history(since)
+        if history is None:
+            raise ValueError("History needs protocol_version >= 1 and a "
+                             "server with -history")
+        self._history = history.records
+
+    def is_ReadHistory_allowed(self):
+        return self.get_state() == DevState.ON
+
+    @attribute(dtype=(float,), max_dim_x=1000000, unit="s",
+               doc="Time stamps of the pin transitions, see ReadHistory")
+    def history_times(self):
+        return [record[0] for record in self._history]
+
+    @attribute(dtype=(int,), max_dim_x=1000000,
+               doc="Pins of the pin transitions, see ReadHistory")
+    def history_pins(self):
+        return [record[1] for record in self._history]
+
+    @attribute(dtype=(bool,), max_dim_x=1000000,
+               doc="Levels of the pin transitions, see ReadHistory")
+    def history_levels(self):
+        return [record[2] ^ self.invert_voltage for record in self._history]
+
+    @command(dtype_in=str, doc_in="JSON list of interlock rules")
+    @catch_connection_error
+    def UploadRules(self, rules):
+        if not self.raspberry.upload_rules(json.loads(rules)):
+            raise ValueError("Invalid rules")
+
+    def is_UploadRules_allowed(self):
+        return self.get_state() == DevState.ON
+
+    @command(dtype_out=str,
+             doc_out="JSON rules and hits, null with protocol_version 0")
+    @catch_connection_error
+    def ListRules(self):
+        return json.dumps(self.raspberry.list_rules())
+
+    @command
+    @catch_connection_error
+    def ArmRules(self):
+        self.raspberry.arm_rules()
+
+    def _rules(self):
+        return self.raspberry.list_rules() or []
+
+    @attribute(dtype=(str,), max_dim_x=64, doc="Names of the rules")
+    @catch_connection_error
+    def rule_names(self):
+        return [rule['name'] for rule in self._rules()]
+
+    @attribute(dtype=(int,), max_dim_x=64,
+               doc="Times each rule fired, see rule_names")
+    @catch_connection_error
+    def rule_hits(self):
+        return [rule['hits'] for rule in self._rules()]
+
     @command
     def TurnOff(self):
+        self._invalidate_snapshot()
         self.raspberry.turnoff()
         self.set_state(DevState.OFF)
 
@@ -147,6 +724,7 @@ class RaspberryPiIO(Device):
 
     @command
     def ResetAll(self):
+        self._invalidate_snapshot()
         self.raspberry.resetall()
 
     def is_ResetAll_allowed(self):
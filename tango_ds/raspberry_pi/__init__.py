@@ -1 +1,17 @@
-from .RaspberryPiIO import run
+# The device servers are imported on demand, the RPi client does not
+# need tango
+
+
+def run(args=None, **kwargs):
+    from .RaspberryPiIO import run
+    return run(args, **kwargs)
+
+
+def run_async(args=None, **kwargs):
+    from .AsyncRaspberryPiIO import run
+    return run(args, **kwargs)
+
+
+def run_fleet(args=None, **kwargs):
+    from .RaspberryPiFleet import run
+    return run(args, **kwargs)
@@ -4,6 +4,7 @@ Error decorator for the Raspberry Pi Tango Device Server.
 """
 
 
+import asyncio
 import socket
 from functools import wraps
 from tango import DevState
@@ -11,15 +12,31 @@ from tango import DevState
 
 def catch_connection_error(func):
     """Decorator for connection errors."""
-    
+    if asyncio.iscoroutinefunction(func):
+        return catch_async_connection_error(func)
+
     @wraps(func)
     def wrapper(self, *args, **kwargs):
         try:
             return func(self, *args, **kwargs)
-        except (BrokenPipeError, ConnectionRefusedError,
-                socket.timeout) as connectionerror:
+        except (BrokenPipeError, ConnectionError,
+                socket.timeout, OSError) as connectionerror:
             self.set_state(DevState.FAULT)
 #            self.debug_stream('Unable to connect to Raspberry Pi TCP/IP'
 #                                + ' server.')
             raise ValueError("Connection error")
     return wrapper
+
+
+def catch_async_connection_error(func):
+    """Decorator for connection errors of coroutines."""
+
+    @wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        try:
+            return await func(self, *args, **kwargs)
+        except (BrokenPipeError, ConnectionError,
+                socket.timeout, OSError) as connectionerror:
+            self.set_state(DevState.FAULT)
+            raise ValueError("Connection error")
+    return wrapper
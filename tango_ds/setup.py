@@ -12,7 +12,11 @@ setup(
     },
     packages=['raspberry_pi'],
     entry_points={
-        'console_scripts': ['RaspberryPiIO = raspberry_pi:run']
+        'console_scripts': [
+            'RaspberryPiIO = raspberry_pi:run',
+            'AsyncRaspberryPiIO = raspberry_pi:run_async',
+            'RaspberryPiFleet = raspberry_pi:run_fleet',
+        ]
     },
     zip_safe=False,
     license="GPLv3",
@@ -20,7 +24,7 @@ setup(
     author="J. Sundberg, Antoine Dupre, Juliano Murari",
     author_email="jens.sundberg@maxiv.lu.se, antoine.dupre@maxiv.lu.se, juliano.murari@maxiv.lu.se",
     url="http://www.maxiv.lu.se",
-    install_requires=['setuptools', 'pytango>=9.2.1', 'requests'],
+    install_requires=['setuptools', 'pytango>=9.3.2', 'requests'],
     setup_requires=['setuptools_scm', 'pytest-runner'],
     extra_requires={
         'test': ['pytest-runner', 'pytest-xdist', 'pytest-mock'],
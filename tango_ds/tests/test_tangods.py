@@ -1,6 +1,10 @@
+import json
 import pytest
 import random
-from collections import deque, MutableMapping
+import time
+from collections import deque
+from collections.abc import MutableMapping
+from contextlib import ExitStack
 from raspberry_pi import RaspberryPiIO, RPi
 from tango.test_context import DeviceTestContext
 from tango import DevState, DevFailed
@@ -59,6 +63,12 @@ class QuerryMap(MutableMapping):
     def __repr__(self):
         return self._store.__repr__()
 
+def to_bytes(value):
+    """ Encode a pre-set answer like the TCP server does """
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode()
+
 def mock_socket(mocker):
     # Create mock
     tcp = mocker.Mock()
@@ -73,7 +83,8 @@ def mock_socket(mocker):
     # socket.endall calls add args to the query queue
     sendall = mocker.Mock(side_effect= lambda x:query_queue.append(x))
     # socket.recv returns associted replie from the first element in the queue
-    recv = mocker.Mock(side_effect=lambda x: query_map[query_queue.popleft()])
+    recv = mocker.Mock(
+        side_effect=lambda x: to_bytes(query_map[query_queue.popleft()]))
     # Setup mocks
     tcp.sendall = sendall
     tcp.recv = recv
@@ -83,12 +94,27 @@ def mock_socket(mocker):
 
 
 @pytest.fixture
-def scope_device(mocker):
+def make_device(mocker):
+    """ Return a function starting the device with the socket mock
+        Properties are added to the default ones, replies pre-set before
+        the device starts. It returns the device and the mocks
+    """
     tcp, query_map, query_queue = mock_socket(mocker)
-    with DeviceTestContext(RaspberryPiIO.RaspberryPiIO,
-                           properties={"Host": "hello",
-                                       "pins": PIN_LIST}) as ds:
-        yield ds, tcp, query_map, query_queue
+    with ExitStack() as stack:
+        def make(replies=None, **properties):
+            query_map.update(replies or {})
+            properties = dict({"Host": "hello", "pins": PIN_LIST},
+                              **properties)
+            ds = stack.enter_context(DeviceTestContext(
+                RaspberryPiIO.RaspberryPiIO, properties=properties))
+            return ds, tcp, query_map, query_queue
+        yield make
+
+
+@pytest.fixture
+def scope_device(make_device):
+    return make_device()
+
 
 @pytest.fixture(params=PIN_LIST)
 def raspberry_pin(request):
@@ -122,10 +148,11 @@ def test_pin_output(scope_device, raspberry_pin):
     assert read_query in query_map.history
     # Assert read out
     assert output == expected_ouput
-    # Write pin output
+    # Write pin output, the output is read back
+    query_map[read_query] = True
     ds.write_attribute(attribute_name, True)
     # Assert query has been sent
-    assert write_query == query_queue.popleft()
+    assert write_query in query_map.history
 
 
 def test_pin_voltage(scope_device, raspberry_pin):
@@ -185,3 +212,105 @@ def test_turnoff(scope_device):
     # Test that device is ON
     assert ds.state() == DevState.ON
 
+
+def test_read_attributes_snapshot(make_device):
+    # Extract mocks
+    ds, tcp, query_map, query_queue = make_device(snapshot_max_age=10.0)
+    # Expected bulk query
+    read_query = "{} READPINS;".format(",".join(map(str, PIN_LIST))).encode()
+    # Generate voltages, pins are all setup as outputs
+    expected = {pin: bool(random.getrandbits(1)) for pin in PIN_LIST}
+    query_map[read_query] = ",".join(
+        "{}:{}:True".format(pin, expected[pin]) for pin in PIN_LIST).encode()
+    # Read every attribute in one request
+    names = ["pin{}_voltage".format(pin) for pin in PIN_LIST]
+    names += ["pin{}_output".format(pin) for pin in PIN_LIST]
+    values = [attr.value for attr in ds.read_attributes(names)]
+    # Assert a single bulk query served the whole request
+    assert query_map.history.count(read_query) == 1
+    assert not any(b"READVOLTAGE" in q for q in query_map.history)
+    assert not any(b"READOUTPUT" in q for q in query_map.history)
+    # Assert read out
+    assert values == [expected[pin] for pin in PIN_LIST] + [True] * len(PIN_LIST)
+
+
+def test_reconnect(scope_device):
+    # Extract mocks
+    ds, tcp, query_map, query_queue = scope_device
+    sendall = tcp.sendall.side_effect
+    # Break the connection
+    tcp.sendall.side_effect = BrokenPipeError
+    with pytest.raises(DevFailed, match="Connection error"):
+        ds.read_attribute("pin3_voltage")
+    # Restore the connection
+    tcp.sendall.side_effect = sendall
+    # Test that device recovers without init
+    assert ds.state() == DevState.ON
+    assert tcp.connect.call_count == 2
+    assert ds.reconnections == 1
+    assert ds.read_attribute("pin3_voltage").value is True
+
+
+def test_camera_jpeg(make_device, mocker):
+    # Mock the jpg streamer snapshot
+    response = mocker.MagicMock()
+    response.__enter__.return_value = response
+    response.read.return_value = b"jpeg data"
+    response.headers = {"ETag": '"1-0-95"'}
+    urlopen = mocker.patch("urllib.request.urlopen", return_value=response)
+    ds = make_device(camera_period=0.1)[0]
+    # Wait for the first snapshots
+    time.sleep(0.5)
+    request = urlopen.call_args[0][0]
+    assert request.full_url == "http://hello:5000/snapshot.jpg"
+    # Assert the etag of the last frame is sent back
+    assert request.get_header("If-none-match") == '"1-0-95"'
+    fmt, data = ds.read_attribute("camera_jpeg").value
+    assert fmt == "jpeg"
+    assert bytes(data) == b"jpeg data"
+
+
+def test_output_word(make_device):
+    # Extract mocks
+    ds, tcp, query_map, query_queue = make_device(output_word_pins=[3, 5, 7])
+    # Pins 3 and 7 high, a single query for the 3 pins
+    ds.write_attribute("output_word", 0b101)
+    assert b"0xa8 WRITEMASK 0x88;" in query_map.history
+    # Read back the word
+    query_map[b"3,5,7 READPINS;"] = b"3:True:True,5:False:True,7:True:True"
+    assert ds.read_attribute("output_word").value == 0b101
+
+
+def test_cached_startup(make_device, tmp_path):
+    # Pins 3 and 5 cached, the server also has 7
+    (tmp_path / "hello_9788.json").write_text(json.dumps({"pins": [3, 5]}))
+    capabilities = {"protocol": 2, "pins": [3, 5, 7], "actions": [],
+                    "history": 0}
+    replies = {b"CAPABILITIES;": json.dumps(capabilities).encode()}
+    ds = make_device(replies, pins=[3, 5, 7], cache_dir=str(tmp_path))[0]
+    # Wait for the connection in the background
+    for _ in range(50):
+        if ds.state() == DevState.ON:
+            break
+        time.sleep(0.1)
+    assert ds.state() == DevState.ON
+    # The pins of the server are reconciled and cached
+    attributes = ds.get_attribute_list()
+    assert "pin7_voltage" in attributes
+    assert "pin3_voltage" in attributes
+    cache = json.loads((tmp_path / "hello_9788.json").read_text())
+    assert cache == capabilities
+    assert json.loads(ds.read_attribute("capabilities").value) == capabilities
+
+
+def test_invalid_capabilities(make_device, tmp_path):
+    # The server replies capabilities without pins
+    replies = {b"CAPABILITIES;": json.dumps({"protocol": 2}).encode()}
+    ds = make_device(replies, pins=[3, 5, 7], cache_dir=str(tmp_path))[0]
+    # The device does not stay in INIT
+    for _ in range(50):
+        if ds.state() != DevState.INIT:
+            break
+        time.sleep(0.1)
+    assert ds.state() == DevState.FAULT
+    assert "Invalid capabilities" in ds.status()
@@ -0,0 +1,224 @@
+"""
+In-memory simulator of the RPi.GPIO module, used by the TCP server off
+the Raspberry Pi (rpi_gpio_server.py -backend sim).
+Pins are numbered in BOARD mode. Inputs read their pull resistor level
+unless driven with set_input. Every GPIO call can be delayed by a fixed
+latency to mimic a slow board.
+"""
+
+import queue
+import threading
+import time
+
+BOARD = 10
+BCM = 11
+OUT = 0
+IN = 1
+LOW = 0
+HIGH = 1
+PUD_OFF = 20
+PUD_DOWN = 21
+PUD_UP = 22
+RISING = 31
+FALLING = 32
+BOTH = 33
+
+# BOARD numbers of the GPIO pins
+CHANNELS = (3, 5, 7, 8, 10, 11, 12, 13, 15, 16, 18, 19, 21, 22, 23, 24, 26,
+            29, 31, 32, 33, 35, 36, 37, 38, 40)
+
+
+class SimulatedPWM:
+    """Software PWM of a simulated pin, same interface as GPIO.PWM."""
+
+    def __init__(self, gpio, channel, frequency):
+        self.gpio = gpio
+        self.channel = channel
+        self.frequency = frequency
+        self.duty = 0.0
+        self.running = False
+
+    def start(self, duty):
+        self.duty = duty
+        self.running = True
+
+    def ChangeFrequency(self, frequency):
+        self.frequency = frequency
+
+    def ChangeDutyCycle(self, duty):
+        self.duty = duty
+
+    def stop(self):
+        self.running = False
+        with self.gpio.lock:
+            if self.gpio.pwms.get(self.channel) is self:
+                del self.gpio.pwms[self.channel]
+
+
+class SimulatedGPIO:
+    """Same interface as the RPi.GPIO module."""
+
+    BOARD = BOARD
+    BCM = BCM
+    OUT = OUT
+    IN = IN
+    LOW = LOW
+    HIGH = HIGH
+    PUD_OFF = PUD_OFF
+    PUD_DOWN = PUD_DOWN
+    PUD_UP = PUD_UP
+    RISING = RISING
+    FALLING = FALLING
+    BOTH = BOTH
+
+    def __init__(self, latency=0.0):
+        # Delay (s) of every GPIO call
+        self.latency = latency
+        self.lock = threading.RLock()
+        # Function of the pins for the board, kept by the hardware
+        self.functions = {}
+        self.pulls = {}
+        # Levels written to the outputs and driven on the inputs
+        self.levels = {}
+        self.driven = {}
+        # Directions set up by this process, like gpio_direction in
+        # RPi.GPIO: the checks of the calls rely on it
+        self.directions = {}
+        # {pin: (edge, callback)}
+        self.detections = {}
+        # {pin: SimulatedPWM}
+        self.pwms = {}
+        # Callbacks run in one thread, like the RPi.GPIO event thread
+        self.events = queue.Queue()
+        thread = threading.Thread(target=self._run_callbacks)
+        thread.daemon = True
+        thread.start()
+
+    def _wait(self):
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def _check(self, channel):
+        if channel not in CHANNELS:
+            raise ValueError("The channel sent is invalid on a Raspberry Pi")
+
+    def _run_callbacks(self):
+        while True:
+            callback, channel = self.events.get()
+            callback(channel)
+
+    def _level(self, channel):
+        if self.functions.get(channel, IN) == OUT:
+            return self.levels.get(channel, LOW)
+        if channel in self.driven:
+            return self.driven[channel]
+        return HIGH if self.pulls.get(channel) == PUD_UP else LOW
+
+    def _changed(self, channel, old):
+        new = self._level(channel)
+        if new == old or channel not in self.detections:
+            return
+        edge, callback = self.detections[channel]
+        if edge == BOTH or edge == (RISING if new else FALLING):
+            self.events.put((callback, channel))
+
+    def setmode(self, mode):
+        pass
+
+    def setwarnings(self, flag):
+        pass
+
+    def gpio_function(self, channel):
+        self._wait()
+        self._check(channel)
+        with self.lock:
+            return self.functions.get(channel, IN)
+
+    def setup(self, channel, direction, pull_up_down=PUD_OFF, initial=None):
+        self._wait()
+        self._check(channel)
+        with self.lock:
+            old = self._level(channel)
+            self.functions[channel] = direction
+            self.pulls[channel] = pull_up_down
+            if direction == OUT:
+                self.levels[channel] = initial or LOW
+            self.directions[channel] = direction
+            self._changed(channel, old)
+
+    def output(self, channel, value):
+        self._wait()
+        # One channel or lists of channels and values
+        if isinstance(channel, (list, tuple)):
+            channels, values = channel, value
+        else:
+            channels, values = [channel], [value]
+        with self.lock:
+            for channel in channels:
+                self._check(channel)
+                if self.directions.get(channel) != OUT:
+                    raise RuntimeError("The GPIO channel has not been set "
+                                       "up as an OUTPUT")
+            for channel, value in zip(channels, values):
+                self.levels[channel] = HIGH if value else LOW
+
+    def input(self, channel):
+        self._wait()
+        self._check(channel)
+        with self.lock:
+            if channel not in self.directions:
+                raise RuntimeError("You must setup() the GPIO channel first")
+            return self._level(channel)
+
+    def cleanup(self, channels=None):
+        self._wait()
+        with self.lock:
+            if channels is None:
+                channels = list(self.directions)
+            for channel in channels:
+                self.detections.pop(channel, None)
+                self.functions.pop(channel, None)
+                self.pulls.pop(channel, None)
+                self.levels.pop(channel, None)
+                self.directions.pop(channel, None)
+
+    def add_event_detect(self, channel, edge, callback=None, bouncetime=None):
+        self._wait()
+        self._check(channel)
+        with self.lock:
+            if self.directions.get(channel) != IN:
+                raise RuntimeError("You must setup() the GPIO channel as an "
+                                   "input first")
+            if channel in self.detections:
+                raise RuntimeError("Conflicting edge detection already "
+                                   "enabled for this GPIO channel")
+            self.detections[channel] = (edge, callback)
+
+    def remove_event_detect(self, channel):
+        self._wait()
+        with self.lock:
+            self.detections.pop(channel, None)
+
+    def PWM(self, channel, frequency):
+        self._wait()
+        self._check(channel)
+        with self.lock:
+            if self.directions.get(channel) != OUT:
+                raise RuntimeError("You must setup() the GPIO channel as an "
+                                   "output first")
+            if channel in self.pwms:
+                raise RuntimeError("A PWM object already exists for this "
+                                   "GPIO channel")
+            pwm = self.pwms[channel] = SimulatedPWM(self, channel, frequency)
+            return pwm
+
+    def set_input(self, channel, level):
+        """Drive an input pin from outside the board, None releases it."""
+        self._check(channel)
+        with self.lock:
+            old = self._level(channel)
+            if level is None:
+                self.driven.pop(channel, None)
+            else:
+                self.driven[channel] = HIGH if level else LOW
+            self._changed(channel, old)
@@ -1,39 +1,64 @@
 """ Flask server example to display RPI camera under serveral webbrowser """
 
-from flask import Flask, Response
+from flask import Flask, Response, jsonify, request
 
 try:
     import cv3 as cv
 except ImportError:
     import cv2 as cv
-from gevent.pypwsgi import WSGIServer
-from gevent.queue import Queue
+from gevent.pywsgi import WSGIServer
+from gevent.event import AsyncResult, Event
 import gevent
+from collections import defaultdict, deque
+from itertools import count
 from time import time
 from weakref import WeakSet
+import argparse
 import logging
 
 # Setup logger
 logger = logging.getLogger(__name__)
 
-# Setup list for client queues
+# Setup list for the connected clients
 listeners = WeakSet()
+client_ids = count(1)
+
+# Last durations (s) timed by TimeIt, by name, see /stats
+timings = defaultdict(lambda: deque(maxlen=1000))
 
 # Flask application
 app = Flask(__name__)
+# Default JPEG quality (1-100) and max age (s) of a snapshot, see main
+app.config["JPEG_QUALITY"] = 95
+app.config["SNAPSHOT_MAX_AGE"] = 0.1
 
 
 class TimeIt:
-    """ Context manager to time excecution """
+    """ Context manager to time excecution, recorded in timings[name] """
 
-    def __init__(self, prefix=""):
+    def __init__(self, prefix="", name=None):
         self.prefix = prefix
+        self.name = name
 
     def __enter__(self):
         self.ref = time()
 
     def __exit__(self, *arg):
-        logger.debug("{}:{}s".format(self.prefix, time() - self.ref))
+        duration = time() - self.ref
+        if self.name is not None:
+            timings[self.name].append(duration)
+        logger.debug("{}:{}s".format(self.prefix, duration))
+
+
+def summary(durations):
+    """ Return the count, median and 99th percentile of durations """
+    durations = sorted(durations)
+    if not durations:
+        return {"count": 0}
+    return {"count": len(durations),
+            "p50": durations[len(durations) // 2],
+            "p99": durations[min(int(len(durations) * 0.99),
+                                 len(durations) - 1)]}
 
 
 class Singleton(type):
@@ -47,76 +72,294 @@ class Singleton(type):
         return cls._cls[cls]
 
 
+def encode(image, width=None, quality=95):
+    """ Encode an image to jpg, downscaled to width keeping the ratio """
+    with TimeIt("encode {} {}".format(width, quality), "encode"):
+        if width:
+            height = max(1, image.shape[0] * width // image.shape[1])
+            image = cv.resize(image, (width, height),
+                              interpolation=cv.INTER_AREA)
+        img = cv.imencode(".jpg", image, [cv.IMWRITE_JPEG_QUALITY, quality])
+        # View of the encoder buffer, no copy
+        return memoryview(img[1].reshape(-1))
+
+
+class Frame:
+    """ One captured image and its jpg variants, encoded once on demand.
+        A frame captured in MJPEG comes with its jpg data, which is
+        forwarded as is for the full size stream without a quality.
+    """
+
+    def __init__(self, image=None, data=None, width=None):
+        self._image = image
+        self.data = data
+        self.width = image.shape[1] if image is not None else width
+        # (width, quality): AsyncResult of the encoded jpg
+        self.variants = {}
+
+    @property
+    def image(self):
+        if self._image is None:
+            with TimeIt("decode", "decode"):
+                self._image = cv.imdecode(self.data, cv.IMREAD_COLOR)
+        return self._image
+
+    def encode(self, width, quality):
+        return encode(self.image, width, quality)
+
+    def jpeg(self, width=None, quality=None):
+        """ Return the jpg data, quality None is the one of the camera for
+            the MJPEG frames, the default JPEG_QUALITY otherwise """
+        # Downscaling only
+        if width and width >= self.width:
+            width = None
+        if width is None and quality is None and self.data is not None:
+            # Compressed by the camera
+            return memoryview(self.data)
+        if quality is None:
+            quality = app.config["JPEG_QUALITY"]
+        key = (width, quality)
+        result = self.variants.get(key)
+        if result is None:
+            # First client asking encodes, the others wait for the result
+            result = self.variants[key] = AsyncResult()
+            pool = gevent.get_hub().threadpool
+            try:
+                result.set(pool.apply(self.encode, (width, quality)))
+            except Exception as exc:
+                result.set_exception(exc)
+        return result.get()
+
+
+class FrameSlot:
+    """ Latest encoded frame and its sequence number, shared by the clients.
+        Clients only wait for a newer frame, the stale ones are skipped.
+    """
+
+    def __init__(self):
+        self.frame = None
+        self.sequence = 0
+        self.time = 0.0
+        self._event = Event()
+        # Number of clients waiting for a frame, and the event waking up
+        # the acquisition when a client starts waiting
+        self.waiting = 0
+        self.requested = Event()
+        # Publication times of the last frames, for the frame rate
+        self.times = deque(maxlen=100)
+
+    def publish(self, frame):
+        self.frame = frame
+        self.sequence += 1
+        self.time = frame.time = time()
+        self.times.append(self.time)
+        # Wake up the waiting clients and arm a new event for the next frame
+        event, self._event = self._event, Event()
+        event.set()
+
+    def wait(self, sequence):
+        """ Return (sequence, frame) of a frame newer than sequence """
+        self.waiting += 1
+        try:
+            while self.sequence <= sequence:
+                self.requested.set()
+                self._event.wait()
+        finally:
+            self.waiting -= 1
+        return self.sequence, self.frame
+
+    def fps(self):
+        """ Frame rate of the last published frames """
+        if len(self.times) < 2 or time() - self.time > 1.0:
+            return 0.0
+        return (len(self.times) - 1) / (self.times[-1] - self.times[0])
+
+
+class Client:
+    """ Frame counters of one stream client """
+
+    def __init__(self):
+        self.id = next(client_ids)
+        self.sent = 0
+        self.dropped = 0
+
+
+# Latest frame published by the acquisition
+slot = FrameSlot()
+
+
 class Video:
     """ Manage the video capture """
 
     __metaclass__ = Singleton
 
-    def __init__(self):
+    def __init__(self, width=1920, height=1080, fps=0, mjpeg=False):
         # Setup open CV capture
         self.cap = cv.VideoCapture(0)
+        # Ask the camera for jpg frames first, the format sets the
+        # available resolutions
+        self.mjpeg = mjpeg and self.setup_mjpeg()
         # Define resolution
-        # TODO: Make resolustion configurable ?
-        self.cap.set(3, 1920.0)
-        self.cap.set(4, 1080.0)
+        self.cap.set(cv.CAP_PROP_FRAME_WIDTH, float(width))
+        self.cap.set(cv.CAP_PROP_FRAME_HEIGHT, float(height))
+        if fps > 0:
+            self.cap.set(cv.CAP_PROP_FPS, float(fps))
+        self.width = int(self.cap.get(cv.CAP_PROP_FRAME_WIDTH))
+        if mjpeg and not self.mjpeg:
+            logger.warning("MJPEG capture not supported, "
+                           "frames are encoded")
+
+    def setup_mjpeg(self):
+        """ Return whether the camera delivers the raw MJPEG buffers """
+        fourcc = cv.VideoWriter_fourcc(*"MJPG")
+        if not self.cap.set(cv.CAP_PROP_FOURCC, fourcc):
+            return False
+        if int(self.cap.get(cv.CAP_PROP_FOURCC)) != fourcc:
+            return False
+        # Skip the decoding of the frames by OpenCV
+        return self.cap.set(cv.CAP_PROP_CONVERT_RGB, 0)
 
     def read_video_frame(self):
-        with TimeIt("Video::read_video_frame"):
+        with TimeIt("Video::read_video_frame", "capture"):
             ret, frame = self.cap.read()
-            # Encode frame to jpg
-            img = cv.imencode(".jpg", frame)
-            return img[1].tobytes()
+            if self.mjpeg and frame.ndim < 3:
+                # Buffer of the jpg data
+                return Frame(data=frame.reshape(-1), width=self.width)
+            return Frame(frame)
 
 
-def video_capture():
-    """ A continious video acquisition"""
-    video_cap = Video()
+def video_capture(fps=10.0, width=1920, height=1080, mjpeg=False):
+    """ A continious video acquisition, fps 0 runs at the camera speed """
+    video_cap = Video(width, height, fps, mjpeg)
+    # cap.read and imencode are blocking C calls releasing the GIL. Run
+    # them in a native thread so that the client greenlets keep running
+    pool = gevent.get_hub().threadpool
+    period = 1.0 / fps if fps > 0 else 0.0
     while True:
-        # Get frame only when client
-        if len(listeners):
-            frame = video_cap.read_video_frame()
-            # Send the video frame to all clients
-            for q in listeners:
-                q.put(frame)
-        # Force sleep time to manage other client.
-        # TODO: make it configurable ?
-        gevent.sleep(0.1)
-
-
-def event_genertor(queue, q_id):
+        start = time()
+        # Get frame only when client, streaming or waiting for a snapshot
+        if len(listeners) or slot.waiting:
+            frame = pool.apply(video_cap.read_video_frame)
+            # Publish the video frame to all clients
+            slot.publish(frame)
+        else:
+            # Wait for a client
+            slot.requested.wait()
+            slot.requested.clear()
+            continue
+        # Let the other greenlets run and keep the frame rate
+        gevent.sleep(max(0.0, period - (time() - start)))
+
+
+def event_genertor(client, width=None, quality=None):
     """ Handle one client connection """
-    while True:
-        with TimeIt("Queue {}:: Wait for data".format(q_id)):
-            # Wait for video acquisition
-            frame = queue.get()
-        # Publish a video a frame.
-        yield (
-            b"--frame\r\n"
-            b"Content-Type: image/jpeg\r\n\r\n" + frame + b"\r\n"
-        )
+    sequence = slot.sequence
+    try:
+        while True:
+            with TimeIt("Client {}:: Wait for data".format(client.id)):
+                # Wait for video acquisition
+                last, (sequence, frame) = sequence, slot.wait(sequence)
+            # Frames published while the client was busy are skipped
+            client.dropped += sequence - last - 1
+            client.sent += 1
+            # Variants are encoded once per frame for all the clients
+            published, frame = frame.time, frame.jpeg(width, quality)
+            # Time from the publication to the client
+            timings["fanout"].append(time() - published)
+            # Publish a video a frame, the jpg buffer is not copied
+            yield b"--frame\r\nContent-Type: image/jpeg\r\n\r\n"
+            yield frame
+            yield b"\r\n"
+    finally:
+        listeners.discard(client)
+
+
+def image_args():
+    """ Return the width and quality of a request, None if not set.
+        A width below 1 is the full size, the quality is clamped to 1-100 """
+    width = request.args.get("width", type=int)
+    if width is not None and width < 1:
+        width = None
+    quality = request.args.get("quality", type=int)
+    if quality is not None:
+        quality = min(max(quality, 1), 100)
+    return width, quality
 
 
 @app.route("/stream")
 def video():
     logger.info("New client connection.")
-    queue = Queue()
-    listeners.add(queue)
+    # Optional downscaled and/or lower quality stream
+    width, quality = image_args()
+    client = Client()
+    listeners.add(client)
     logger.info("{} client listining".format(len(listeners)))
     return Response(
-        event_genertor(queue, len(listeners)),
+        event_genertor(client, width, quality),
         mimetype="multipart/x-mixed-replace; boundary=frame",
     )
 
 
-def main():
+@app.route("/snapshot.jpg")
+def snapshot():
+    width, quality = image_args()
+    sequence, frame = slot.sequence, slot.frame
+    # The frames of a running stream are fresh, otherwise capture one
+    if frame is None or time() - slot.time > app.config["SNAPSHOT_MAX_AGE"]:
+        sequence, frame = slot.wait(sequence)
+    # 0 for the full size and the default quality
+    etag = "{}-{}-{}".format(sequence, width or 0, quality or 0)
+    if request.if_none_match.contains(etag):
+        # Already got by the client, nothing to encode
+        response = Response(status=304)
+    else:
+        data = frame.jpeg(width, quality)
+        response = Response([data], mimetype="image/jpeg")
+        response.content_length = len(data)
+    response.set_etag(etag)
+    response.headers["X-Frame-Sequence"] = str(sequence)
+    response.cache_control.no_cache = True
+    return response
+
+
+@app.route("/stats")
+def stats():
+    clients = [{"id": c.id, "sent": c.sent, "dropped": c.dropped}
+               for c in sorted(listeners, key=lambda c: c.id)]
+    return jsonify(sequence=slot.sequence, clients=clients, fps=slot.fps(),
+                   timings={name: summary(durations)
+                            for name, durations in list(timings.items())})
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Raspberry PI camera stream.')
+    parser.add_argument('-host', metavar='HOST', type=str,
+                        default='0.0.0.0', help='host ip (str)')
+    parser.add_argument('-port', metavar='PORT', type=int,
+                        default=5000, help='port number (int)')
+    parser.add_argument('-fps', metavar='FPS', type=float, default=10.0,
+                        help='frames per second, 0 for the camera speed '
+                        '(float)')
+    parser.add_argument('-width', metavar='WIDTH', type=int,
+                        default=1920, help='capture width (int)')
+    parser.add_argument('-height', metavar='HEIGHT', type=int,
+                        default=1080, help='capture height (int)')
+    parser.add_argument('-quality', metavar='QUALITY', type=int,
+                        default=95, help='default jpg quality 1-100 (int)')
+    parser.add_argument('-mjpeg', metavar='MJPEG', type=str, default='n',
+                        help='forward the camera MJPEG frames, falls back '
+                        'to encoding y/n (str)')
+    args = parser.parse_args(args)
     logging.basicConfig(level=logging.DEBUG)
     global app
     app.debug = True
-    host = "0.0.0.0"
-    port = 5000
-    server = WSGIServer((host, port), app)
+    app.config["JPEG_QUALITY"] = args.quality
+    # A snapshot is taken from the stream if not older than a frame period
+    app.config["SNAPSHOT_MAX_AGE"] = 1.0 / args.fps if args.fps > 0 else 0.0
+    server = WSGIServer((args.host, args.port), app)
     # Schedule the acquistion greenlet
-    gevent.spawn(video_capture)
+    gevent.spawn(video_capture, args.fps, args.width, args.height,
+                 args.mjpeg == 'y')
     server.serve_forever()
 
 
@@ -1,6 +1,5 @@
 #!/bin/bash
 while [ True ]; do
-	ping -c1 your-gateway-etc 
 	sleep 1
 	ps -aux | grep -v grep | grep rpi_gpio_server > /dev/null
 	if [ $? -eq 0 ]; then
@@ -7,97 +7,1019 @@ try:
     import socketserver
 except ImportError:
     import SocketServer as socketserver
-import RPi.GPIO as GPIO
+try:
+    import RPi.GPIO as GPIO
+except ImportError:
+    # Not on a Raspberry Pi, see use_backend
+    GPIO = None
 import argparse
+import array
+import json
+import queue
+import socket
+import struct
 import subprocess
+import threading
+import time
+from collections import deque
+
+if GPIO is not None:
+    GPIO.setmode(GPIO.BOARD)
+    GPIO.setwarnings(False)
+
+# Binary framing, negotiated by the client with "<version> PROTOCOL;".
+# Version 0 is the legacy ";" separated text protocol.
+PROTOCOL_VERSION = 2
+# Frame headers: version, kind, [request id,] payload length
+HEADERS = {
+    1: struct.Struct("!BBI"),
+    2: struct.Struct("!BBII"),
+}
+KIND_TEXT = 0
+KIND_PINS = 1
+KIND_EVENT = 2
+KIND_SAMPLES = 3
+KIND_HISTORY = 4
+# Pins payload: pins, pins with a known voltage, voltages, outputs (bitmasks)
+PINS = struct.Struct("!QQQQ")
+# Event payload: pin, voltage, time stamp (seconds since the epoch)
+EVENT = struct.Struct("!BBd")
+# Samples payload: start time stamp (s since the epoch), mean sampling
+# period (s), samples count. Followed by one bit-plane per pin: count
+# bits, most significant bit first, padded to a byte
+SAMPLES = struct.Struct("!ddI")
+MAX_SAMPLES = 1000000
+# History payload: server monotonic and epoch times of the reply, records
+# count. Followed by the records: monotonic time stamp, pin, level
+HISTORY = struct.Struct("!ddI")
+RECORD = struct.Struct("!dBB")
+EDGES = ('RISING', 'FALLING', 'BOTH')
+# Long actions taking the GPIO lock themselves, only when needed
+UNLOCKED_ACTIONS = ('SAMPLE',)
+# Actions of this server, see CAPABILITIES
+ACTIONS = ('SETVOLTAGE', 'SETOUTPUT', 'RESET', 'OFF', 'READVOLTAGE',
+           'READOUTPUT', 'READPINSLIST', 'READALL', 'READPINS', 'PROTOCOL',
+           'SUBSCRIBE', 'UNSUBSCRIBE', 'WRITEMASK', 'PULSE', 'PWM', 'SAMPLE',
+           'HISTORY', 'RULES', 'LISTRULES', 'ARMRULES', 'STATS',
+           'CAPABILITIES')
+
+
+def set_socket_options(sock, nodelay=True, keepalive_idle=0,
+                       keepalive_interval=5, keepalive_count=3):
+    """Disable Nagle and enable TCP keepalive (when keepalive_idle > 0)."""
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(nodelay))
+    if keepalive_idle <= 0:
+        return
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    # Linux only options
+    if hasattr(socket, "TCP_KEEPIDLE"):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE,
+                        int(keepalive_idle))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL,
+                        int(keepalive_interval))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT,
+                        int(keepalive_count))
+
+
+def use_backend(backend, latency=0.0):
+    """Select the GPIO backend, 'rpi' (RPi.GPIO) or 'sim' (simulator).
+
+    The simulator delays every GPIO call by latency (s).
+    """
+    global GPIO
+    if backend == 'sim':
+        import gpio_simulator
+        GPIO = gpio_simulator.SimulatedGPIO(latency)
+    elif backend == 'rpi':
+        import RPi.GPIO as GPIO
+    else:
+        raise ValueError("Unknown GPIO backend: {}".format(backend))
+    GPIO.setmode(GPIO.BOARD)
+    GPIO.setwarnings(False)
+    return GPIO
+
+
+def action_name(command):
+    """Return the action of a command, e.g. READVOLTAGE for "3 READVOLTAGE"."""
+    words = command.split()
+    return words[min(1, len(words) - 1)] if words else ''
+
+
+class ServerStats:
+    """Service times of the actions and depth of the GPIO queue."""
+
+    def __init__(self, size=1000):
+        self.size = size
+        self.lock = threading.Lock()
+        self.start = time.time()
+        # {action: [count, total time, max time, last size times]}
+        self.actions = {}
+        # Commands waiting for the GPIO lock
+        self.queued = 0
+        self.max_queued = 0
+
+    def enqueue(self):
+        with self.lock:
+            self.queued += 1
+            self.max_queued = max(self.max_queued, self.queued)
+
+    def dequeue(self):
+        with self.lock:
+            self.queued -= 1
+
+    def add(self, action, duration):
+        with self.lock:
+            stats = self.actions.get(action)
+            if stats is None:
+                stats = [0, 0.0, 0.0, deque(maxlen=self.size)]
+                self.actions[action] = stats
+            stats[0] += 1
+            stats[1] += duration
+            stats[2] = max(stats[2], duration)
+            stats[3].append(duration)
+
+    def as_dict(self):
+        """Return the statistics, times in s."""
+        with self.lock:
+            actions = {}
+            for action, (count, total, longest, last) in self.actions.items():
+                last = sorted(last)
+                actions[action] = {
+                    "count": count,
+                    "mean": total / count,
+                    "max": longest,
+                    "p50": last[len(last) // 2],
+                    "p99": last[min(int(len(last) * 0.99), len(last) - 1)],
+                }
+            return {"uptime": time.time() - self.start,
+                    "queue_depth": self.queued,
+                    "max_queue_depth": self.max_queued,
+                    "actions": actions}
+
+
+def sleep_until(deadline):
+    """Sleep until a perf_counter deadline, spinning the last ms."""
+    remaining = deadline - time.perf_counter()
+    if remaining > 0.002:
+        time.sleep(remaining - 0.001)
+    while time.perf_counter() < deadline:
+        pass
+
+
+class History:
+    """Ring buffer of the last size pin transitions.
+
+    Records are (monotonic time stamp, pin, level), time ordered.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.times = array.array('d', bytes(8 * size))
+        self.pins = array.array('B', bytes(size))
+        self.levels = array.array('B', bytes(size))
+        # Number of records ever added
+        self.added = 0
+        self.lock = threading.Lock()
+
+    def add(self, pin, level):
+        with self.lock:
+            i = self.added % self.size
+            self.times[i] = time.monotonic()
+            self.pins[i] = pin
+            self.levels[i] = 1 if level else 0
+            self.added += 1
+
+    def since(self, start, pins=None):
+        """Return the records at or after a monotonic time, oldest first."""
+        with self.lock:
+            first = max(0, self.added - self.size)
+            # Binary search of the first record at or after start
+            low, high = first, self.added
+            while low < high:
+                middle = (low + high) // 2
+                if self.times[middle % self.size] < start:
+                    low = middle + 1
+                else:
+                    high = middle
+            records = []
+            for n in range(low, self.added):
+                i = n % self.size
+                if pins is None or self.pins[i] in pins:
+                    records.append((self.times[i], self.pins[i],
+                                    self.levels[i]))
+            return records
+
+
+class Rule:
+    """Interlock rule evaluated by the server on the edges of an input.
+
+    Built from a dict like:
+        {"name": "interlock",
+         "when": {"pin": 11, "edge": "RISING", "conditions": {"12": true}},
+         "then": [{"pin": 13, "level": false, "delay_ms": 0}],
+         "latch": false}
+    When the edge of the when pin occurs and the other pins are at the
+    condition levels, the then pins are written after their delay. A
+    latched rule fires once, until re-armed (ARMRULES or a new upload).
+    """
+
+    __slots__ = ('name', 'pin', 'edge', 'conditions', 'actions', 'latch',
+                 'armed', 'hits')
+
+    def __init__(self, spec, index=0):
+        when = spec['when']
+        self.name = str(spec.get('name', 'rule{}'.format(index)))
+        self.pin = int(when['pin'])
+        self.edge = when.get('edge', 'BOTH')
+        if self.edge not in EDGES:
+            raise ValueError("Unknown edge: {}".format(self.edge))
+        self.conditions = {int(p): bool(level) for p, level
+                           in when.get('conditions', {}).items()}
+        self.actions = [(int(a['pin']), bool(a['level']),
+                         float(a.get('delay_ms', 0)) / 1000.)
+                        for a in spec['then']]
+        if any(delay < 0 for _, _, delay in self.actions):
+            raise ValueError("Negative delay")
+        self.latch = bool(spec.get('latch', False))
+        self.armed = True
+        self.hits = 0
+
+    def triggered(self, pin, voltage):
+        if not self.armed or pin != self.pin:
+            return False
+        return (self.edge == 'BOTH' or
+                self.edge == ('RISING' if voltage else 'FALLING'))
+
+    def as_dict(self):
+        return {'name': self.name,
+                'when': {'pin': self.pin, 'edge': self.edge,
+                         'conditions': {str(p): level for p, level
+                                        in self.conditions.items()}},
+                'then': [{'pin': p, 'level': level, 'delay_ms': delay * 1000}
+                         for p, level, delay in self.actions],
+                'latch': self.latch, 'armed': self.armed, 'hits': self.hits}
+
 
-GPIO.setmode(GPIO.BOARD)
-GPIO.setwarnings(False)
+class PinState:
+    """Server side record of a pin, kept up to date by the TCP handlers."""
+
+    __slots__ = ('direction', 'pull', 'level', 'configured')
+
+    def __init__(self, direction, pull=None, level=None, configured=False):
+        # GPIO.OUT, GPIO.IN or another gpio_function value
+        self.direction = direction
+        self.pull = pull
+        # Last level written to an output, None if unknown
+        self.level = level
+        # Whether GPIO.setup was called on the pin by this process
+        self.configured = configured
 
 
 class TCP(socketserver.BaseRequestHandler):
 
     pinlist = [3, 5, 7, 8, 10, 11, 12, 13, 15, 16, 18, 19, 21, 22, 23, 24, 26,
                29, 31, 32, 33, 35, 36, 38, 37, 40]
+    # Serialize the GPIO access of the client threads
+    gpio_lock = threading.RLock()
+    # Client sockets setup: timeout (s, None blocks) and
+    # set_socket_options keywords, see main
+    timeout = None
+    socket_options = {}
+    # Authoritative {pin: PinState} table, only used with gpio_lock held
+    pin_states = {}
+    # Edge subscriptions {pin: {handler: edge}} shared by the clients
+    subscribers = {}
+    subscribers_lock = threading.Lock()
+    # Service times and queue depth of all the clients, see STATS
+    stats = ServerStats()
+    # Timed outputs running on the Pi: {pin: stop event} of the pulse
+    # trains and {pin: GPIO.PWM}. The trains write the pins holding
+    # pulse_lock, not gpio_lock
+    pulses = {}
+    pwms = {}
+    pulse_lock = threading.Lock()
+    # Pins with an edge detection added by the server, for the
+    # subscribers and the rules
+    detected = set()
+    # Interlock rules evaluated on the edges, see RULES
+    rules = []
+    # History of the edges and writes, None if disabled, see main
+    history = None
+    # Edge events queued per subscriber, a client falling further behind
+    # is disconnected
+    event_queue_size = 1000
+
+    def setup(self):
+        # Negotiated protocol version and bytes received but not handled yet
+        self.version = 0
+        self.buffer = b""
+        # Id of the request being handled, echoed in the reply (version 2)
+        self.request_id = 0
+        # Replies and edge events are sent from different threads
+        self.send_lock = threading.Lock()
+        # Replies built with gpio_lock held, sent once it is released
+        self.replies = []
+        # Event frames sent by the writer thread, see push_event
+        self.events = None
+        self.request.settimeout(self.timeout)
+        set_socket_options(self.request, **self.socket_options)
+
+    def finish(self):
+        with self.subscribers_lock:
+            pins = [p for p, handlers in self.subscribers.items()
+                    if self in handlers]
+        with self.gpio_lock:
+            for pin in pins:
+                self.unsubscribe(pin, reply=False)
+        if self.events is not None:
+            try:
+                # Stop the writer thread
+                self.events.put_nowait(None)
+            except queue.Full:
+                # The writer fails on the closed socket
+                pass
 
     def handle(self):
-        # self.request.settimeout(5)
         print("Client connection: {}".format(self.client_address[0]))
         while True:
-            data = self.request.recv(1024).strip()
+            try:
+                data = self.request.recv(1024)
+            except socket.timeout:
+                print("Client timed out: {}".format(self.client_address[0]))
+                break
             if not data:
                 break
             # print("{} wrote:".format(self.client_address[0]))
-            data = str(data).replace("'", "")
-            data = data.replace("b", "")
-            data = data.strip()
-            data = data.split(";")
-            for d in data:
-                if d:
-                    self.gpio_action(d)
+            self.buffer += data
+            command = self.next_command()
+            while command is not None:
+                if command:
+                    action = action_name(command)
+                    start = time.perf_counter()
+                    if action in UNLOCKED_ACTIONS:
+                        self.gpio_action(command)
+                    else:
+                        self.stats.enqueue()
+                        with self.gpio_lock:
+                            self.stats.dequeue()
+                            start = time.perf_counter()
+                            self.gpio_action(command)
+                    self.stats.add(action, time.perf_counter() - start)
+                command = self.next_command()
+            # One send for the replies of the commands received, a client
+            # not reading them only blocks itself
+            self.flush()
         print("Client disconnected: {}".format(self.client_address[0]))
 
+    def next_command(self):
+        """Pop the next complete command from the buffer, None if none."""
+        if self.version:
+            header = HEADERS[self.version]
+            if len(self.buffer) < header.size:
+                return None
+            fields = header.unpack_from(self.buffer)
+            end = header.size + fields[-1]
+            if len(self.buffer) < end:
+                return None
+            if self.version >= 2:
+                self.request_id = fields[2]
+            data = self.buffer[header.size:end]
+            self.buffer = self.buffer[end:]
+        else:
+            data, sep, rest = self.buffer.partition(b";")
+            if not sep:
+                return None
+            self.buffer = rest
+        return data.decode().strip()
+
+    def frame(self, kind, payload, request_id=None):
+        """Return the bytes sending a payload with the protocol version."""
+        if request_id is None:
+            request_id = self.request_id
+        if self.version >= 2:
+            header = HEADERS[2].pack(self.version, kind, request_id,
+                                     len(payload))
+            return header + payload
+        elif self.version:
+            return HEADERS[1].pack(self.version, kind,
+                                   len(payload)) + payload
+        return payload
+
+    def send_frame(self, kind, payload, request_id=None):
+        """Queue a reply, sent by flush."""
+        self.replies.append(self.frame(kind, payload, request_id))
+
+    def flush(self):
+        if not self.replies:
+            return
+        data, self.replies = b"".join(self.replies), []
+        with self.send_lock:
+            self.request.sendall(data)
+
+    def push_event(self, payload):
+        """Queue an edge event for the writer thread, never blocks.
+
+        A client not reading its events is disconnected when its queue
+        is full.
+        """
+        try:
+            self.events.put_nowait(self.frame(KIND_EVENT, payload, 0))
+        except queue.Full:
+            print("Client not reading its events: {}".format(
+                self.client_address[0]))
+            try:
+                # Also wakes up the writer and the handler threads
+                self.request.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def write_events(self, events):
+        while True:
+            data = events.get()
+            if data is None:
+                return
+            try:
+                with self.send_lock:
+                    self.request.sendall(data)
+            except OSError:
+                # Disconnected, the handler unsubscribes when it finishes
+                return
+
+    def reply(self, text):
+        self.send_frame(KIND_TEXT, text.encode())
+
+    def negotiate(self, version):
+        # Answer in the current protocol, then switch
+        version = min(int(version), PROTOCOL_VERSION)
+        self.reply(str(version))
+        self.version = version
+
+    def pin_state(self, pin):
+        """Return the PinState of a pin, read from the GPIO the first time."""
+        pin = int(pin)
+        state = self.pin_states.get(pin)
+        if state is None:
+            state = PinState(GPIO.gpio_function(pin))
+            self.pin_states[pin] = state
+        return state
+
+    def output_state(self, pin):
+        """Return the PinState of an output pin, None for an input."""
+        state = self.pin_state(pin)
+        if state.direction == GPIO.IN:
+            return None
+        if not state.configured:
+            # Output for the board but not setup by this process
+            self.set_output(pin, 'True')
+            state = self.pin_state(pin)
+        return state
+
+    def input_state(self, pin):
+        """Return the PinState of an input pin, None for an output.
+
+        The pin is setup as an input if not done by this process yet,
+        RPi.GPIO refuses the edge detection otherwise.
+        """
+        state = self.pin_state(pin)
+        if state.direction != GPIO.IN:
+            return None
+        if not state.configured:
+            GPIO.setup(int(pin), GPIO.IN)
+            state = PinState(GPIO.IN, GPIO.PUD_OFF, configured=True)
+            self.pin_states[int(pin)] = state
+        return state
+
     def set_voltage(self, pin, setvalue):
-        if GPIO.gpio_function(int(pin)) == 1:
+        state = self.output_state(pin)
+        if state is None:
             boolstr = 'False'
-            self.request.sendall(boolstr.encode())
+            self.reply(boolstr)
         else:
-            if setvalue == 'True':
-                try:
-                    GPIO.output(int(pin), GPIO.HIGH)
-                except RuntimeError:
-                    self.set_output(int(pin), 'True')
-                    GPIO.output(int(pin), GPIO.HIGH)
-            else:
-                try:
-                    GPIO.output(int(pin), GPIO.LOW)
-                except RuntimeError:
-                    self.set_output(int(pin), 'True')
-                    GPIO.output(int(pin), GPIO.LOW)
+            self.stop_timed(int(pin))
+            level = setvalue == 'True'
+            GPIO.output(int(pin), GPIO.HIGH if level else GPIO.LOW)
+            state.level = level
+            self.record(int(pin), level)
             boolstr = 'True'
-            self.request.sendall(boolstr.encode())
+            self.reply(boolstr)
 
     def set_output(self, pin, setvalue):
+        self.stop_timed(int(pin))
         if setvalue == 'True':
+            # No more edges to record
+            self.remove_detection(int(pin), keep_recorded=False)
+            if int(pin) in self.detected:
+                print("Pin {} is subscribed or triggers a rule, kept as an "
+                      "input".format(pin))
+                return
             GPIO.setup(int(pin), GPIO.OUT)
+            self.pin_states[int(pin)] = PinState(GPIO.OUT, configured=True)
         else:
             GPIO.setup(int(pin), GPIO.IN)
+            self.pin_states[int(pin)] = PinState(GPIO.IN, GPIO.PUD_OFF,
+                                                 configured=True)
+            if self.history is not None:
+                # Record the edges of the inputs
+                self.add_detection(int(pin))
 
     def reset(self, pin):
         if pin == 'ALL':
+            self.stop_timed()
             GPIO.cleanup(self.pinlist)
+            # The cleanup sets the pins back to inputs
+            for p in self.pinlist:
+                self.pin_states[p] = PinState(GPIO.IN, GPIO.PUD_OFF)
+            # The cleanup removed the edge detection of subscribed pins
+            # and of the rules
+            self.detected.clear()
+            with self.subscribers_lock:
+                pins = set(self.subscribers)
+            for p in pins | self.rule_pins():
+                self.set_output(p, 'False')
+                self.add_detection(p)
+
+    def write_mask(self, mask, values=None):
+        """Write the levels of several output pins at once.
+
+        mask and values are bitmasks, bit n is board pin n. Nothing is
+        written unless all the pins of the mask are outputs.
+        """
+        try:
+            mask, values = int(mask, 0), int(values, 0)
+        except (TypeError, ValueError):
+            self.reply('False')
+            return
+        pins = [p for p in range(64) if mask >> p & 1]
+        states = [self.output_state(p) if p in self.pinlist else None
+                  for p in pins]
+        if not pins or None in states:
+            self.reply('False')
+            return
+        for pin in pins:
+            self.stop_timed(pin)
+        levels = [bool(values >> p & 1) for p in pins]
+        # A single call for all the pins
+        GPIO.output(pins, [GPIO.HIGH if l else GPIO.LOW for l in levels])
+        for pin, state, level in zip(pins, states, levels):
+            state.level = level
+            self.record(pin, level)
+        self.reply('True')
+
+    @classmethod
+    def stop_timed(cls, pin=None):
+        """Stop the pulse train or PWM of a pin, of all pins if None."""
+        pins = cls.pinlist if pin is None else [pin]
+        with cls.pulse_lock:
+            for p in pins:
+                stop = cls.pulses.pop(p, None)
+                if stop is not None:
+                    stop.set()
+        for p in pins:
+            pwm = cls.pwms.pop(p, None)
+            if pwm is not None:
+                pwm.stop()
+
+    def pulse(self, pin, width=None, count='1', period=None):
+        """Start count high pulses of width us every period us.
+
+        The pulses are timed by a thread of the server, the reply is sent
+        when they start. The period defaults to twice the width.
+        """
+        try:
+            pin, width, count = int(pin), float(width) * 1e-6, int(count)
+            period = float(period) * 1e-6 if period else 2 * width
+        except (TypeError, ValueError):
+            self.reply('False')
+            return
+        if pin not in self.pinlist:
+            self.reply('False')
+            return
+        state = self.output_state(pin)
+        if state is None or width <= 0 or count < 1 or period < width:
+            self.reply('False')
+            return
+        self.stop_timed(pin)
+        stop = threading.Event()
+        self.pulses[pin] = stop
+        thread = threading.Thread(target=self.pulse_train,
+                                  args=(pin, state, width, count, period,
+                                        stop))
+        thread.daemon = True
+        thread.start()
+        self.reply('True')
+
+    @classmethod
+    def pulse_train(cls, pin, state, width, count, period, stop):
+        start = time.perf_counter()
+        for i in range(count):
+            for level, deadline in ((True, start + i * period),
+                                    (False, start + i * period + width)):
+                sleep_until(deadline)
+                with cls.pulse_lock:
+                    if stop.is_set():
+                        return
+                    GPIO.output(pin, GPIO.HIGH if level else GPIO.LOW)
+                    state.level = level
+                cls.record(pin, level)
+        with cls.pulse_lock:
+            if cls.pulses.get(pin) is stop:
+                del cls.pulses[pin]
+
+    def pwm(self, pin, frequency=None, duty=None):
+        """Start the PWM of a pin at frequency Hz and duty cycle %.
+
+        A frequency of 0 stops it.
+        """
+        try:
+            pin, frequency, duty = int(pin), float(frequency), float(duty)
+        except (TypeError, ValueError):
+            self.reply('False')
+            return
+        if pin not in self.pinlist:
+            self.reply('False')
+            return
+        state = self.output_state(pin)
+        if state is None or not 0 <= duty <= 100 or frequency < 0:
+            self.reply('False')
+            return
+        pwm = self.pwms.get(pin)
+        if frequency == 0:
+            self.stop_timed(pin)
+        elif pwm is not None:
+            pwm.ChangeFrequency(frequency)
+            pwm.ChangeDutyCycle(duty)
+        else:
+            self.stop_timed(pin)
+            pwm = GPIO.PWM(pin, frequency)
+            pwm.start(duty)
+            self.pwms[pin] = pwm
+        # Level unknown while running
+        state.level = None
+        self.reply('True')
+
+    @classmethod
+    def edge_callback(cls, pin):
+        """Push an event to the clients subscribed to an edge of the pin.
+
+        Called from the RPi.GPIO event thread. The events are queued, so
+        a slow client does not delay the rules nor the other clients.
+        """
+        timestamp = time.time()
+        voltage = GPIO.input(pin)
+        cls.record(pin, voltage)
+        if cls.rules:
+            with cls.gpio_lock:
+                cls.fire_rules(pin, voltage)
+        with cls.subscribers_lock:
+            handlers = list(cls.subscribers.get(pin, {}).items())
+        payload = EVENT.pack(pin, voltage, timestamp)
+        for handler, edge in handlers:
+            if edge == 'RISING' and not voltage:
+                continue
+            if edge == 'FALLING' and voltage:
+                continue
+            handler.push_event(payload)
+
+    def add_detection(self, pin):
+        """Detect the edges of an input pin, return False if impossible."""
+        if pin in self.detected:
+            return True
+        try:
+            GPIO.add_event_detect(pin, GPIO.BOTH, callback=self.edge_callback)
+        except RuntimeError:
+            # Not an input or detection already added by someone else
+            return False
+        self.detected.add(pin)
+        return True
+
+    def remove_detection(self, pin, keep_recorded=True):
+        """Stop detecting the edges of a pin if no longer needed.
+
+        The edges of the inputs are kept for the history, unless
+        keep_recorded is False.
+        """
+        with self.subscribers_lock:
+            subscribed = pin in self.subscribers
+        state = self.pin_states.get(pin)
+        recorded = (keep_recorded and self.history is not None and
+                    state is not None and state.direction == GPIO.IN and
+                    state.configured)
+        if pin in self.detected and not subscribed and not recorded \
+                and pin not in self.rule_pins():
+            GPIO.remove_event_detect(pin)
+            self.detected.discard(pin)
+
+    @classmethod
+    def record(cls, pin, level):
+        if cls.history is not None:
+            cls.history.add(pin, level)
+
+    def read_history(self, since, pins=None):
+        """Reply with the records since a server monotonic time, relative
+        to now if negative. Only with the binary framing."""
+        if not self.version or self.history is None:
+            self.reply('False')
+            return
+        try:
+            since = float(since)
+            if pins is not None:
+                pins = {int(p) for p in pins.split(",") if p}
+        except ValueError:
+            self.reply('False')
+            return
+        now = time.monotonic()
+        if since < 0:
+            since += now
+        records = self.history.since(since, pins)
+        payload = HISTORY.pack(now, time.time(), len(records)) + b"".join(
+            RECORD.pack(*record) for record in records)
+        self.send_frame(KIND_HISTORY, payload)
+
+    @classmethod
+    def rule_pins(cls):
+        return {rule.pin for rule in cls.rules}
+
+    @classmethod
+    def fire_rules(cls, pin, voltage):
+        """Apply the rules triggered by an edge, gpio_lock held."""
+        for rule in cls.rules:
+            if not rule.triggered(pin, voltage):
+                continue
+            if any(cls.pin_level(p) != level
+                   for p, level in rule.conditions.items()):
+                continue
+            rule.hits += 1
+            if rule.latch:
+                rule.armed = False
+            for p, level, delay in rule.actions:
+                if delay:
+                    timer = threading.Timer(delay, cls.rule_action,
+                                            args=(p, level))
+                    timer.daemon = True
+                    timer.start()
+                else:
+                    cls.write_level(p, level)
+
+    @classmethod
+    def rule_action(cls, pin, level):
+        with cls.gpio_lock:
+            cls.write_level(pin, level)
+
+    @classmethod
+    def pin_level(cls, pin):
+        """Return the level of a pin, None if unknown."""
+        state = cls.pin_states.get(pin)
+        if state is not None and state.direction == GPIO.OUT \
+                and state.level is not None:
+            return state.level
+        try:
+            return GPIO.input(pin) == 1
+        except RuntimeError:
+            return None
+
+    @classmethod
+    def write_level(cls, pin, level):
+        """Write an output pin set up by the server, gpio_lock held."""
+        state = cls.pin_states.get(pin)
+        if state is None or state.direction != GPIO.OUT \
+                or not state.configured:
+            return
+        cls.stop_timed(pin)
+        GPIO.output(pin, GPIO.HIGH if level else GPIO.LOW)
+        state.level = level
+        cls.record(pin, level)
+
+    def upload_rules(self, text):
+        """Replace the rules by a JSON list of rules, see Rule."""
+        try:
+            rules = [Rule(spec, i) for i, spec in enumerate(json.loads(text))]
+        except (ValueError, KeyError, TypeError, AttributeError):
+            self.reply('False')
+            return
+        for rule in rules:
+            valid = (rule.pin in self.pinlist and
+                     self.input_state(rule.pin) is not None and
+                     all(p in self.pinlist for p in rule.conditions) and
+                     all(p in self.pinlist and self.output_state(p)
+                         for p, _, _ in rule.actions))
+            if not valid:
+                self.reply('False')
+                return
+        pins = {rule.pin for rule in rules}
+        if not all(self.add_detection(p) for p in pins):
+            # Keeps the detections of the current rules
+            for p in pins:
+                self.remove_detection(p)
+            self.reply('False')
+            return
+        old, type(self).rules = self.rules, rules
+        for p in {rule.pin for rule in old} - pins:
+            self.remove_detection(p)
+        self.reply('True')
+
+    def list_rules(self):
+        """Reply with the rules and their hits as JSON, null with the text
+        protocol."""
+        if not self.version:
+            self.reply('null')
+            return
+        self.reply(json.dumps([rule.as_dict() for rule in self.rules]))
+
+    def arm_rules(self):
+        for rule in self.rules:
+            rule.armed = True
+        self.reply('True')
+
+    def subscribe(self, pin, edge):
+        """Push the edges of an input pin to this client.
+
+        Events are only sent with the binary framing.
+        """
+        try:
+            pin = int(pin)
+        except ValueError:
+            self.reply('False')
+            return
+        if not self.version or edge not in EDGES or pin not in self.pinlist:
+            self.reply('False')
+            return
+        if self.input_state(pin) is None:
+            self.reply('False')
+            return
+        if not self.add_detection(pin):
+            self.reply('False')
+            return
+        if self.events is None:
+            self.events = queue.Queue(self.event_queue_size)
+            thread = threading.Thread(target=self.write_events,
+                                      args=(self.events,))
+            thread.daemon = True
+            thread.start()
+        with self.subscribers_lock:
+            self.subscribers.setdefault(pin, {})[self] = edge
+        self.reply('True')
+
+    def unsubscribe(self, pin, reply=True):
+        try:
+            pin = int(pin)
+        except ValueError:
+            self.reply('False')
+            return
+        with self.subscribers_lock:
+            handlers = self.subscribers.get(pin, {})
+            handlers.pop(self, None)
+            if pin in self.subscribers and not handlers:
+                del self.subscribers[pin]
+        self.remove_detection(pin)
+        if reply:
+            self.reply('True')
 
     def off(self):
+        self.stop_timed()
         for pin in self.pinlist:
-            if GPIO.gpio_function(pin) == 0:
+            if self.pin_state(pin).direction == GPIO.OUT:
                 GPIO.setup(pin, GPIO.OUT, initial=GPIO.LOW)
+                self.pin_states[pin] = PinState(GPIO.OUT, level=False,
+                                                configured=True)
+                self.record(pin, False)
             else:
                 GPIO.setup(pin, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
+                self.pin_states[pin] = PinState(GPIO.IN, GPIO.PUD_DOWN,
+                                                configured=True)
 
-    def read_voltage(self, pin):
+    def voltage_str(self, pin):
+        state = self.pin_state(pin)
+        if state.direction == GPIO.OUT and state.level is not None:
+            # Written by this process, no need to sample it
+            return str(state.level)
         try:
             if GPIO.input(int(pin)) == 1:
-                boolstr = 'True'
-            else:
-                boolstr = 'False'
-            self.request.sendall(boolstr.encode())
+                return 'True'
+            return 'False'
         except RuntimeError:
-            boolstr = 'None'
-            self.request.sendall(boolstr.encode())
+            return 'None'
+
+    def output_str(self, pin):
+        if self.pin_state(pin).direction == GPIO.OUT:
+            return 'True'
+        return 'False'
+
+    def read_voltage(self, pin):
+        boolstr = self.voltage_str(pin)
+        self.reply(boolstr)
 
     def read_output(self, pin):
-        if GPIO.gpio_function(int(pin)) == 0:
-            boolstr = 'True'
-        else:
-            boolstr = 'False'
-        self.request.sendall(boolstr.encode())
+        boolstr = self.output_str(pin)
+        self.reply(boolstr)
 
     def read_pin_list(self):
         values = [str(i) for i in self.pinlist]
         values = ",".join(values)
-        self.request.sendall(values.encode())
+        self.reply(values)
+
+    def read_pins(self, pins=None):
+        """Reply with the voltage and output of every pin.
+
+        Text replies are "pin:voltage:output" items, comma separated.
+        Binary replies are a PINS bitmask payload.
+        """
+        if pins is None:
+            pins = self.pinlist
+        else:
+            try:
+                pins = [int(p) for p in pins.split(",") if p]
+            except ValueError:
+                self.reply('False')
+                return
+            pins = [p for p in pins if p in self.pinlist]
+        if not self.version:
+            values = ["{}:{}:{}".format(p, self.voltage_str(p),
+                                        self.output_str(p)) for p in pins]
+            values = ",".join(values)
+            self.reply(values)
+            return
+        mask = known = voltages = outputs = 0
+        for p in pins:
+            bit = 1 << p
+            mask |= bit
+            voltage = self.voltage_str(p)
+            if voltage != 'None':
+                known |= bit
+            if voltage == 'True':
+                voltages |= bit
+            if self.output_str(p) == 'True':
+                outputs |= bit
+        self.send_frame(KIND_PINS, PINS.pack(mask, known, voltages, outputs))
+
+    def sample(self, pins, rate=None, count=None):
+        """Sample the levels of pins count times at rate Hz.
+
+        Reply with a SAMPLES payload, only with the binary framing. The
+        GPIO lock is not held while sampling.
+        """
+        try:
+            pins = [int(p) for p in pins.split(",") if p]
+            rate, count = float(rate), int(count)
+        except (TypeError, ValueError):
+            self.reply('False')
+            return
+        with self.gpio_lock:
+            valid = (self.version and pins and len(pins) <= 64 and
+                     0 < rate <= 1e6 and 0 < count <= MAX_SAMPLES and
+                     all(p in self.pinlist and self.pin_level(p) is not None
+                         for p in pins))
+        if not valid:
+            self.reply('False')
+            return
+        read = GPIO.input
+        words = array.array('Q')
+        period = 1.0 / rate
+        timestamp = time.time()
+        start = time.perf_counter()
+        for i in range(count):
+            sleep_until(start + i * period)
+            word = 0
+            for bit, pin in enumerate(pins):
+                if read(pin):
+                    word |= 1 << bit
+            words.append(word)
+        period = (time.perf_counter() - start) / count
+        size = (count + 7) // 8
+        planes = []
+        for bit in range(len(pins)):
+            bits = "".join("1" if w >> bit & 1 else "0" for w in words)
+            planes.append(int(bits, 2) << (size * 8 - count))
+        payload = SAMPLES.pack(timestamp, period, count) + b"".join(
+            plane.to_bytes(size, "big") for plane in planes)
+        self.send_frame(KIND_SAMPLES, payload)
+
+    def read_stats(self):
+        """Reply with the statistics as JSON, null with the text protocol
+        whose replies are limited to one recv by the clients."""
+        if not self.version:
+            self.reply('null')
+            return
+        stats = self.stats.as_dict()
+        stats["clients"] = getattr(self.server, "clients", 1)
+        self.reply(json.dumps(stats))
+
+    def read_capabilities(self):
+        """Reply with the descriptor of the server as JSON: protocol
+        version, pins, actions and history size. Small enough for the
+        text protocol."""
+        self.reply(json.dumps({
+            "protocol": PROTOCOL_VERSION,
+            "pins": self.pinlist,
+            "actions": ACTIONS,
+            "history": self.history.size if self.history else 0,
+        }))
 
     def gpio_action(self, data):
+        words = data.split(None, 2)
+        if words[1:2] == ['RULES']:
+            # The JSON rules contain spaces
+            self.upload_rules(words[2] if len(words) > 2 else '')
+            return
         actionlist = data.split()
         if len(actionlist) == 1:
             action = actionlist[0]
@@ -134,8 +1056,96 @@ class TCP(socketserver.BaseRequestHandler):
         elif action == 'READPINSLIST':
             self.read_pin_list()
 
+        # readall: voltage and output of every pin in one reply
+        elif action == 'READALL':
+            self.read_pins()
+
+        # readpins: same as readall for a comma separated list of pins
+        elif action == 'READPINS':
+            self.read_pins(pin)
+
+        # protocol: switch to the binary framing
+        elif action == 'PROTOCOL':
+            self.negotiate(pin)
+
+        # subscribe: push RISING, FALLING or BOTH edges of the pin
+        elif action == 'SUBSCRIBE':
+            if len(actionlist) > 2:
+                self.subscribe(pin, setvalue)
+            else:
+                self.subscribe(pin, 'BOTH')
+
+        elif action == 'UNSUBSCRIBE':
+            self.unsubscribe(pin)
+
+        # writemask: <mask> WRITEMASK <values>, pin n is bit n
+        elif action == 'WRITEMASK':
+            self.write_mask(pin, *actionlist[2:3])
+
+        # pulse: <pin> PULSE <width us> [count] [period us]
+        elif action == 'PULSE':
+            self.pulse(pin, *actionlist[2:5])
+
+        # pwm: <pin> PWM <frequency Hz> <duty cycle %>
+        elif action == 'PWM':
+            self.pwm(pin, *actionlist[2:4])
+
+        # sample: <pins> SAMPLE <rate Hz> <count>, binary framing only
+        elif action == 'SAMPLE':
+            self.sample(pin, *actionlist[2:4])
+
+        # history: <since> HISTORY [pins], binary framing only
+        elif action == 'HISTORY':
+            self.read_history(pin, *actionlist[2:3])
+
+        # listrules: rules and hits, JSON
+        elif action == 'LISTRULES':
+            self.list_rules()
+
+        # armrules: re-arm the latched rules
+        elif action == 'ARMRULES':
+            self.arm_rules()
+
+        # stats: service times and queue depth, JSON
+        elif action == 'STATS':
+            self.read_stats()
+
+        # capabilities: protocol, pins and actions of the server, JSON
+        elif action == 'CAPABILITIES':
+            self.read_capabilities()
+
+
+class ThreadedServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """TCP server handling each client connection in its own thread."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, server_address, handler_class, max_clients=8):
+        self.max_clients = max_clients
+        self.clients = 0
+        self.clients_lock = threading.Lock()
+        socketserver.TCPServer.__init__(self, server_address, handler_class)
+
+    def verify_request(self, request, client_address):
+        with self.clients_lock:
+            if self.max_clients and self.clients >= self.max_clients:
+                print("Client refused, {} clients connected: {}".format(
+                    self.clients, client_address[0]))
+                return False
+            self.clients += 1
+        return True
+
+    def process_request_thread(self, request, client_address):
+        try:
+            socketserver.ThreadingMixIn.process_request_thread(
+                self, request, client_address)
+        finally:
+            with self.clients_lock:
+                self.clients -= 1
+
 
-def main():
+def main(args=None):
     parser = argparse.ArgumentParser(description='Raspberry PI TCP/IP Server.')
     parser.add_argument('-host', metavar='HOST', type=str,
                         default='0.0.0.0', help='host ip number (str)')
@@ -143,12 +1153,52 @@ def main():
                         default=9788, help='host port number (int)')
     parser.add_argument('-camera', metavar='CAMERA', type=str,
                         default='n', help='camera support y/n (str)')
-    args = parser.parse_args()
+    parser.add_argument('-threaded', metavar='THREADED', type=str,
+                        default='y', help='serve clients concurrently y/n '
+                                          '(str)')
+    parser.add_argument('-clients', metavar='CLIENTS', type=int,
+                        default=8, help='max concurrent clients, 0 for no '
+                                        'limit (int)')
+    parser.add_argument('-timeout', metavar='TIMEOUT', type=float,
+                        default=0, help='disconnect clients idle for TIMEOUT '
+                                        's, 0 for never (float)')
+    parser.add_argument('-nodelay', metavar='NODELAY', type=str,
+                        default='y', help='disable Nagle algorithm y/n (str)')
+    parser.add_argument('-keepalive', metavar='IDLE', type=float,
+                        default=10, help='TCP keepalive idle time in s, 0 '
+                                         'to disable (float)')
+    parser.add_argument('-keepalive-interval', metavar='INTERVAL', type=float,
+                        default=5, help='TCP keepalive probes interval in s '
+                                        '(float)')
+    parser.add_argument('-keepalive-count', metavar='COUNT', type=int,
+                        default=3, help='TCP keepalive probes before '
+                                        'disconnection (int)')
+    parser.add_argument('-backend', metavar='BACKEND', type=str,
+                        default='rpi', help='GPIO backend, rpi or sim for the '
+                                            'simulator (str)')
+    parser.add_argument('-latency', metavar='LATENCY', type=float,
+                        default=0, help='simulator delay of the GPIO calls '
+                                        'in s (float)')
+    parser.add_argument('-history', metavar='HISTORY', type=int,
+                        default=10000, help='pin transitions kept for the '
+                                            'HISTORY command, 0 to disable '
+                                            '(int)')
+    args = parser.parse_args(args)
+    use_backend(args.backend, args.latency)
+    TCP.history = History(args.history) if args.history > 0 else None
+    TCP.timeout = args.timeout or None
+    TCP.socket_options = dict(nodelay=args.nodelay == 'y',
+                              keepalive_idle=args.keepalive,
+                              keepalive_interval=args.keepalive_interval,
+                              keepalive_count=args.keepalive_count)
     HOST, PORT, CAMERA = args.host, args.port, args.camera
     if CAMERA == 'y':
         p = subprocess.Popen("python -c 'import jpg_streamer; "
                              "jpg_streamer.main()'", shell=True)
-    server = socketserver.TCPServer((HOST, PORT), TCP)
+    if args.threaded == 'y':
+        server = ThreadedServer((HOST, PORT), TCP, args.clients)
+    else:
+        server = socketserver.TCPServer((HOST, PORT), TCP)
     # interrupt with Ctrl+c
     server.serve_forever()
 
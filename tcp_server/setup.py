@@ -10,7 +10,7 @@ setup(
         "root": "..",
         "relative_to": __file__,
     },
-    py_modules=['rpi_gpio_server', 'advanced_streamer'],
+    py_modules=['rpi_gpio_server', 'gpio_simulator', 'jpg_streamer'],
     entry_points={
         'console_scripts': [
             'tcpserver-raspberry_pi = rpi_gpio_server:main'
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The server modules and the Raspberry client, without installing them
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, os.path.join(HERE, "..", "..", "tango_ds"))
@@ -0,0 +1,614 @@
+import asyncio
+import json
+import queue
+import socket
+import threading
+import time
+import pytest
+import rpi_gpio_server
+from tango import DevFailed, DevState
+from tango.test_context import DeviceTestContext, MultiDeviceTestContext
+from raspberry_pi.AsyncRaspberryPiIO import AsyncRaspberryPiIO
+from raspberry_pi.RaspberryPiFleet import RaspberryPiFleet
+from raspberry_pi.RaspberryPiIO import RaspberryPiIO
+from raspberry_pi import RPi
+from raspberry_pi.RPi import (AsyncRaspberry, Raspberry, RaspberryFleet,
+                             Timings, PROTOCOL_VERSION)
+
+"""
+End-to-end tests of the TCP server with the GPIO simulator backend and
+the Raspberry client, on localhost.
+"""
+
+
+@pytest.fixture
+def server():
+    gpio = rpi_gpio_server.use_backend('sim')
+    # Fresh server side tables
+    rpi_gpio_server.TCP.pin_states = {}
+    rpi_gpio_server.TCP.subscribers = {}
+    rpi_gpio_server.TCP.stats = rpi_gpio_server.ServerStats()
+    rpi_gpio_server.TCP.detected = set()
+    rpi_gpio_server.TCP.rules = []
+    rpi_gpio_server.TCP.history = rpi_gpio_server.History(100)
+    rpi_gpio_server.TCP.event_queue_size = 1000
+    server = rpi_gpio_server.ThreadedServer(("localhost", 0),
+                                            rpi_gpio_server.TCP)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server.server_address[1], gpio
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(params=[0, PROTOCOL_VERSION])
+def raspberry(server, request):
+    port, gpio = server
+    raspberry = Raspberry("localhost", request.param, port=port, timeout=2.0)
+    raspberry.connect_to_pi()
+    yield raspberry, gpio
+    raspberry.disconnect_from_pi()
+
+
+def test_pins_list(raspberry):
+    raspberry, gpio = raspberry
+    assert raspberry.read_pins_list() == rpi_gpio_server.TCP.pinlist
+
+
+def test_set_voltage(raspberry):
+    raspberry, gpio = raspberry
+    # Inputs can not be written
+    raspberry.setoutput(3, False)
+    assert raspberry.setvoltage(3, True) is False
+    raspberry.setoutput(3, True)
+    assert raspberry.readoutput(3) is True
+    assert raspberry.setvoltage(3, True) is True
+    assert gpio.levels[3] == gpio.HIGH
+    assert raspberry.readvoltage(3) is True
+
+
+def test_read_input(raspberry):
+    raspberry, gpio = raspberry
+    raspberry.setoutput(5, False)
+    gpio.set_input(5, True)
+    assert raspberry.readvoltage(5) is True
+    gpio.set_input(5, False)
+    assert raspberry.read_all([5, 7])[5] == (False, False)
+    # Malformed pins
+    assert raspberry.query("a,b READPINS") is False
+    assert raspberry.readvoltage(5) is False
+
+
+def test_pipeline(raspberry):
+    raspberry, gpio = raspberry
+    raspberry.setoutput(7, True)
+    with raspberry.pipeline() as pipe:
+        pipe.setvoltage(7, True)
+        pipe.readvoltage(7)
+        pipe.readoutput(7)
+        assert pipe.execute() == [True, True, True]
+    # The commands left are executed on exit
+    with raspberry.pipeline() as pipe:
+        pipe.setvoltage(7, False)
+    assert gpio.levels[7] == gpio.LOW
+
+
+def test_edge_events(server):
+    port, gpio = server
+    raspberry = Raspberry("localhost", PROTOCOL_VERSION, port=port)
+    raspberry.connect_to_pi()
+    raspberry.setoutput(11, False)
+    assert raspberry.subscribe(11, 'RISING') is True
+    events = queue.Queue()
+
+    def listen():
+        try:
+            raspberry.listen(lambda *event: events.put(event))
+        except OSError:
+            # Disconnected
+            pass
+
+    thread = threading.Thread(target=listen)
+    thread.daemon = True
+    thread.start()
+    gpio.set_input(11, True)
+    gpio.set_input(11, False)
+    gpio.set_input(11, True)
+    assert events.get(timeout=2.0)[:2] == (11, 1)
+    assert events.get(timeout=2.0)[:2] == (11, 1)
+    raspberry.disconnect_from_pi()
+
+
+def test_slow_negotiation(server, monkeypatch):
+    port, gpio = server
+    negotiate = rpi_gpio_server.TCP.negotiate
+
+    def slow_negotiate(self, version):
+        time.sleep(0.5)
+        negotiate(self, version)
+
+    # The server switches to the framing after the client gave up
+    monkeypatch.setattr(rpi_gpio_server.TCP, "negotiate", slow_negotiate)
+    monkeypatch.setattr(RPi, "NEGOTIATION_TIMEOUT", 0.2)
+    raspberry = Raspberry("localhost", PROTOCOL_VERSION, port=port,
+                          timeout=2.0)
+    raspberry.connect_to_pi()
+    assert raspberry.version == 0
+    raspberry.setoutput(3, True)
+    assert raspberry.readoutput(3) is True
+    raspberry.disconnect_from_pi()
+
+    async def queries():
+        raspberry = AsyncRaspberry("localhost", PROTOCOL_VERSION, port=port,
+                                   timeout=2.0)
+        await raspberry.connect_to_pi()
+        output = await raspberry.readoutput(3)
+        await raspberry.disconnect_from_pi()
+        return raspberry.version, output
+
+    assert asyncio.run(queries()) == (0, True)
+
+
+def test_subscribe_not_setup(server):
+    port, gpio = server
+    raspberry = Raspberry("localhost", PROTOCOL_VERSION, port=port)
+    raspberry.connect_to_pi()
+    # The server sets up the input before detecting its edges
+    assert raspberry.subscribe(19, 'BOTH') is True
+    assert gpio.directions[19] == gpio.IN and 19 in gpio.detections
+    # Malformed pins
+    assert raspberry.query("x SUBSCRIBE BOTH") is False
+    assert raspberry.query("x UNSUBSCRIBE") is False
+    assert raspberry.unsubscribe(19) is True
+    raspberry.disconnect_from_pi()
+
+
+def test_output_detected(server):
+    port, gpio = server
+    raspberry = Raspberry("localhost", PROTOCOL_VERSION, port=port)
+    raspberry.connect_to_pi()
+    raspberry.setoutput(11, False)
+    assert raspberry.subscribe(11, 'BOTH') is True
+    # A subscribed input is not made an output
+    raspberry.setoutput(11, True)
+    assert raspberry.readoutput(11) is False
+    assert raspberry.setvoltage(11, True) is False
+    assert 11 in gpio.detections
+    # The edges recorded by the history do not prevent it
+    raspberry.setoutput(12, False)
+    assert raspberry.readoutput(12) is False
+    assert 12 in gpio.detections
+    raspberry.setoutput(12, True)
+    assert raspberry.readoutput(12) is True
+    assert 12 not in gpio.detections
+    raspberry.disconnect_from_pi()
+
+
+@pytest.mark.parametrize("device_class", [RaspberryPiIO, AsyncRaspberryPiIO])
+def test_device_output_detected(server, device_class):
+    port, gpio = server
+    # The edge events subscribe the input pins
+    properties = {"Host": "localhost", "Port": port, "pins": [3, 5],
+                  "protocol_version": PROTOCOL_VERSION, "edge_events": True}
+    with DeviceTestContext(device_class, properties=properties,
+                           process=True) as ds:
+        assert ds.state() == DevState.ON
+        with pytest.raises(DevFailed, match="subscribed or triggers a rule"):
+            ds.write_attribute("pin3_output", True)
+        assert ds.read_attribute("pin3_output").value is False
+        ds.write_attribute("pin5_output", False)
+
+
+def test_slow_subscriber(server):
+    port, gpio = server
+    rpi_gpio_server.TCP.event_queue_size = 10
+    # A subscriber that never reads its events
+    slow = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    slow.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024)
+    slow.connect(("localhost", port))
+    slow.sendall(b"2 PROTOCOL;")
+    assert slow.recv(16) == b"2"
+    command = b"23 SUBSCRIBE BOTH"
+    slow.sendall(rpi_gpio_server.HEADERS[2].pack(2, 0, 1, len(command))
+                 + command)
+    assert wait_for(lambda: 23 in rpi_gpio_server.TCP.subscribers)
+    # It is disconnected when its queue is full
+    for i in range(100000):
+        gpio.set_input(23, i % 2 == 0)
+        if 23 not in rpi_gpio_server.TCP.subscribers:
+            break
+    assert wait_for(lambda: 23 not in rpi_gpio_server.TCP.subscribers)
+    # The events thread is not blocked: it handles the flood and the other
+    # clients still get the events
+    assert wait_for(gpio.events.empty)
+    rpi_gpio_server.TCP.event_queue_size = 1000
+    raspberry = Raspberry("localhost", PROTOCOL_VERSION, port=port)
+    raspberry.connect_to_pi()
+    assert raspberry.subscribe(23, 'RISING') is True
+    events = queue.Queue()
+
+    def listen():
+        try:
+            raspberry.listen(lambda *event: events.put(event))
+        except OSError:
+            # Disconnected
+            pass
+
+    thread = threading.Thread(target=listen)
+    thread.daemon = True
+    thread.start()
+    gpio.set_input(23, False)
+    gpio.set_input(23, True)
+    assert events.get(timeout=2.0)[:2] == (23, 1)
+    slow.close()
+    raspberry.disconnect_from_pi()
+
+
+def test_slow_client(server):
+    port, gpio = server
+    # A client sending commands without reading the replies
+    slow = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    slow.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024)
+    slow.connect(("localhost", port))
+    thread = threading.Thread(target=lambda: slow.sendall(b"READALL;" * 50000))
+    thread.daemon = True
+    thread.start()
+
+    def handled():
+        stats = rpi_gpio_server.TCP.stats.as_dict()["actions"]
+        return stats.get("READALL", {}).get("count", 0)
+
+    # Wait for its replies to fill the socket buffers
+    count = -1
+    while count != handled():
+        count = handled()
+        time.sleep(0.2)
+    # It does not block the other clients
+    raspberry = Raspberry("localhost", port=port, timeout=2.0)
+    raspberry.connect_to_pi()
+    for _ in range(10):
+        assert raspberry.readoutput(3) is False
+    raspberry.disconnect_from_pi()
+    slow.close()
+
+
+def test_stats(raspberry):
+    raspberry, gpio = raspberry
+    raspberry.setoutput(3, True)
+    for _ in range(10):
+        raspberry.readvoltage(3)
+    stats = raspberry.read_stats()
+    if not raspberry.version:
+        # Framed replies only
+        assert stats is None
+    else:
+        assert stats["actions"]["READVOLTAGE"]["count"] == 10
+        assert stats["queue_depth"] == 0
+        assert stats["clients"] == 1
+    # Client side round trip times
+    assert raspberry.timings.summary()["READVOLTAGE"]["count"] == 10
+    assert 0 < raspberry.timings.percentile(0.5) <= \
+        raspberry.timings.percentile(0.99)
+    assert raspberry.timings.rate() > 0
+
+
+def test_slow_connect():
+    # A server that never answers the protocol negotiation
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("localhost", 0))
+    listener.listen(1)
+    raspberry = Raspberry("localhost", PROTOCOL_VERSION,
+                          port=listener.getsockname()[1])
+    errors = []
+
+    def connect():
+        try:
+            raspberry.connect_to_pi()
+        except ConnectionError as error:
+            errors.append(error)
+
+    thread = threading.Thread(target=connect)
+    thread.start()
+    time.sleep(0.1)
+    # The pool is not locked while connecting
+    start = time.perf_counter()
+    raspberry.disconnect_from_pi()
+    assert time.perf_counter() - start < 0.5
+    thread.join()
+    # The connection opened meanwhile is not kept
+    assert len(errors) == 1 and not raspberry.connections
+    listener.close()
+
+
+
+def test_timings_rate():
+    timings = Timings(size=10)
+    for _ in range(5000):
+        timings.add('READVOLTAGE', 0.001)
+    timings.add('PIPELINE', 0.01, 1000)
+    # Not limited by the samples kept
+    assert timings.rate(10.0) == pytest.approx(600.0)
+    assert len(timings.samples['READVOLTAGE']) == 10
+
+
+def test_pulse(raspberry):
+    raspberry, gpio = raspberry
+    # Inputs can not be pulsed
+    raspberry.setoutput(13, False)
+    assert raspberry.pulse(13, 1000) is False
+    raspberry.setoutput(13, True)
+    assert raspberry.pulse(13, 200000) is True
+    time.sleep(0.1)
+    assert raspberry.readvoltage(13) is True
+    time.sleep(0.2)
+    assert raspberry.readvoltage(13) is False
+    # A write stops the pulse train
+    assert raspberry.pulse(13, 100000, 10, 200000) is True
+    assert raspberry.setvoltage(13, True) is True
+    time.sleep(0.2)
+    assert gpio.levels[13] == gpio.HIGH
+
+
+def test_pwm(raspberry):
+    raspberry, gpio = raspberry
+    raspberry.setoutput(15, True)
+    assert raspberry.pwm(15, 100, 25) is True
+    assert (gpio.pwms[15].frequency, gpio.pwms[15].duty) == (100, 25)
+    assert raspberry.pwm(15, 50, 75) is True
+    assert (gpio.pwms[15].frequency, gpio.pwms[15].duty) == (50, 75)
+    assert raspberry.pwm(15, 0, 0) is True
+    assert 15 not in gpio.pwms
+    assert raspberry.pwm(15, 10, 101) is False
+    # Malformed commands
+    assert raspberry.query("15 PWM 100") is False
+    assert raspberry.query("15 PULSE") is False
+    assert raspberry.query("15 PULSE x") is False
+    assert raspberry.pwm(1, 100, 25) is False
+    assert raspberry.readoutput(15) is True
+
+
+def test_write_mask(raspberry):
+    raspberry, gpio = raspberry
+    pins = [3, 5, 7, 8]
+    for pin in pins:
+        raspberry.setoutput(pin, True)
+    assert raspberry.write_pins({3: True, 5: False, 7: True, 8: True})
+    assert [gpio.levels[p] for p in pins] == [1, 0, 1, 1]
+    assert raspberry.write_mask(1 << 3 | 1 << 5, 1 << 5) is True
+    assert [gpio.levels[p] for p in pins] == [0, 1, 1, 1]
+    # Nothing is written if one pin is an input
+    raspberry.setoutput(10, False)
+    assert raspberry.write_pins({3: True, 10: True}) is False
+    assert gpio.levels[3] == 0
+    # Malformed commands, the replies of the batch are still sent
+    with raspberry.pipeline() as pipe:
+        pipe.query("zz WRITEMASK 1")
+        pipe.query("0x8 WRITEMASK")
+        pipe.readoutput(3)
+        assert pipe.execute() == [False, False, True]
+
+
+def wait_for(condition, timeout=2.0):
+    end = time.time() + timeout
+    while not condition() and time.time() < end:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_rules(raspberry):
+    raspberry, gpio = raspberry
+    # Edge detection for the rules only
+    rpi_gpio_server.TCP.history = None
+    raspberry.setoutput(11, False)
+    raspberry.setoutput(12, False)
+    raspberry.setoutput(13, True)
+    raspberry.setvoltage(13, True)
+    rules = [{"name": "interlock;1",
+              "when": {"pin": 11, "edge": "RISING", "conditions": {"12": True}},
+              "then": [{"pin": 13, "level": False}],
+              "latch": True}]
+    # Outputs can not trigger rules
+    assert raspberry.upload_rules([dict(rules[0], when={"pin": 13})]) is False
+    assert raspberry.upload_rules(rules) is True
+    # Condition not met
+    gpio.set_input(11, True)
+    gpio.set_input(11, False)
+    time.sleep(0.1)
+    assert gpio.levels[13] == gpio.HIGH
+    gpio.set_input(12, True)
+    gpio.set_input(11, True)
+    assert wait_for(lambda: gpio.levels[13] == gpio.LOW)
+    if raspberry.version:
+        listed = raspberry.list_rules()
+        assert listed[0]["name"] == "interlock;1"
+        assert (listed[0]["hits"], listed[0]["armed"]) == (1, False)
+    # Latched until re-armed
+    raspberry.setvoltage(13, True)
+    gpio.set_input(11, False)
+    gpio.set_input(11, True)
+    time.sleep(0.1)
+    assert gpio.levels[13] == gpio.HIGH
+    assert raspberry.arm_rules() is True
+    gpio.set_input(11, False)
+    gpio.set_input(11, True)
+    assert wait_for(lambda: gpio.levels[13] == gpio.LOW)
+    # Rules and subscriptions share the edge detection
+    assert raspberry.upload_rules([]) is True
+    assert 11 not in gpio.detections
+
+
+def test_sample(raspberry):
+    raspberry, gpio = raspberry
+    for pin in (16, 18):
+        raspberry.setoutput(pin, False)
+    gpio.set_input(18, True)
+    samples = raspberry.sample([16, 18], 1000, 50)
+    if not raspberry.version:
+        # Binary framing only
+        assert samples is None
+        return
+    assert len(samples.data) == 2
+    assert [list(plane) for plane in samples.data] == [[False] * 50,
+                                                       [True] * 50]
+    assert samples.period == pytest.approx(1e-3, rel=0.5)
+    # Pins not set up can not be sampled
+    assert raspberry.sample([19], 1000, 10) is None
+    assert raspberry.query("16 SAMPLE 1000") is False
+    # Longer than the timeout of the client
+    samples = raspberry.sample([16], 1000, 2500)
+    assert len(samples.data[0]) == 2500
+
+
+def test_history(raspberry):
+    raspberry, gpio = raspberry
+    raspberry.setoutput(21, True)
+    raspberry.setoutput(22, False)
+    raspberry.setvoltage(21, True)
+    gpio.set_input(22, True)
+    assert wait_for(lambda: rpi_gpio_server.TCP.history.added == 2)
+    history = raspberry.history()
+    if not raspberry.version:
+        # Binary framing only
+        assert history is None
+        return
+    assert [record[1:] for record in history.records] == [(21, True),
+                                                          (22, True)]
+    assert history.records[0][0] == pytest.approx(time.time(), abs=5)
+    # Only the next records
+    raspberry.setvoltage(21, False)
+    later = raspberry.history(history.now, [21])
+    assert [record[1:] for record in later.records] == [(21, False)]
+    # Bounded memory
+    for _ in range(60):
+        raspberry.setvoltage(21, True)
+        raspberry.setvoltage(21, False)
+    assert len(raspberry.history().records) == 100
+
+
+def test_capabilities(raspberry):
+    raspberry, gpio = raspberry
+    capabilities = raspberry.read_capabilities()
+    assert capabilities["pins"] == rpi_gpio_server.TCP.pinlist
+    assert capabilities["protocol"] == rpi_gpio_server.PROTOCOL_VERSION
+    assert "WRITEMASK" in capabilities["actions"]
+    assert capabilities["history"] == 100
+
+
+def test_no_capabilities(raspberry, monkeypatch):
+    raspberry, gpio = raspberry
+    # Servers not knowing CAPABILITIES never reply
+    monkeypatch.setattr(rpi_gpio_server.TCP, "read_capabilities",
+                        lambda handler: None)
+    assert raspberry.read_capabilities() is None
+    # Not a connection outage
+    assert raspberry.down_since is None
+    assert raspberry.read_pins_list() == rpi_gpio_server.TCP.pinlist
+    assert raspberry.reconnections == 0
+
+
+@pytest.mark.parametrize("protocol", [0, PROTOCOL_VERSION])
+def test_async_raspberry(server, protocol):
+    port, gpio = server
+
+    async def queries():
+        raspberry = AsyncRaspberry("localhost", protocol, port=port,
+                                   timeout=2.0)
+        # Concurrent queries share the first connection
+        first = await asyncio.gather(
+            *(raspberry.readoutput(pin) for pin in (3, 5, 7, 8)))
+        version = raspberry.version
+        # And the reconnection after a close
+        raspberry.close()
+        second = await asyncio.gather(
+            *(raspberry.readoutput(pin) for pin in (3, 5, 7, 8)))
+        await raspberry.setoutput(3, True)
+        third = await raspberry.readoutput(3)
+        await raspberry.disconnect_from_pi()
+        return first, version, second, third
+
+    first, version, second, third = asyncio.run(queries())
+    assert first == second == [False] * 4
+    assert version == protocol
+    assert third is True
+
+
+def test_async_device(server):
+    port, gpio = server
+    properties = {"Host": "localhost", "Port": port, "pins": [3, 5],
+                  "protocol_version": PROTOCOL_VERSION}
+    devices_info = [{"class": AsyncRaspberryPiIO, "devices": [
+        {"name": "test/rpi/{}".format(i), "properties": properties}
+        for i in (1, 2)]}]
+    with MultiDeviceTestContext(devices_info, process=True) as context:
+        sampler = context.get_device("test/rpi/1")
+        reader = context.get_device("test/rpi/2")
+        assert sampler.state() == reader.state() == DevState.ON
+        reader.write_attribute("pin3_output", True)
+        reader.write_attribute("pin3_voltage", True)
+        reader.write_attribute("pin5_output", False)
+        # One second of sampling on a device does not block the other
+        thread = threading.Thread(target=sampler.Sample,
+                                  args=([50, 50, 5],))
+        thread.start()
+        time.sleep(0.2)
+        start = time.perf_counter()
+        assert reader.read_attribute("pin3_voltage").value is True
+        elapsed = time.perf_counter() - start
+        thread.join()
+        assert list(sampler.read_attribute("sample_pins").value) == [5]
+        assert elapsed < 0.5
+        # The timings are the ones of the client serving the pins
+        assert reader.commands_per_s >= 0.5
+        assert reader.rtt_p50 > 0
+
+
+def test_fleet(server):
+    port, gpio = server
+    # Two names of the same server and a host that is down
+    hosts = ["localhost", "127.0.0.1", "127.0.0.2"]
+
+    async def snapshot():
+        fleet = RaspberryFleet(hosts, port=port, connect_timeout=2.0,
+                               timeout=2.0)
+        connected = await fleet.connect()
+        first = await fleet.read_all([3, 5])
+        online = [fleet.online(host) for host in hosts]
+        # The host that is down fails fast until its backoff expires
+        start = time.perf_counter()
+        second = await fleet.read_all([3])
+        elapsed = time.perf_counter() - start
+        await fleet.close()
+        return connected, first, online, second, elapsed
+
+    raspberry = Raspberry("localhost", port=port, timeout=2.0)
+    raspberry.connect_to_pi()
+    raspberry.setoutput(3, False)
+    raspberry.setoutput(5, False)
+    raspberry.disconnect_from_pi()
+    gpio.set_input(5, True)
+    connected, first, online, second, elapsed = asyncio.run(snapshot())
+    assert connected["localhost"] is None
+    assert isinstance(connected["127.0.0.2"], OSError)
+    assert first["localhost"] == first["127.0.0.1"] == {3: (False, False),
+                                                        5: (True, False)}
+    assert isinstance(first["127.0.0.2"], OSError)
+    assert online == [True, True, False]
+    assert isinstance(second["127.0.0.2"], ConnectionRefusedError)
+    assert elapsed < 1.0
+
+
+def test_fleet_device(server):
+    port, gpio = server
+    properties = {"Hosts": ["localhost", "127.0.0.1"], "Port": port}
+    with DeviceTestContext(RaspberryPiFleet, properties=properties,
+                           process=True) as ds:
+        assert ds.state() == DevState.ON
+        assert ds.online_count == 2
+        # Without the pins property the columns are all the pins
+        pins = rpi_gpio_server.TCP.pinlist
+        assert list(ds.columns) == sorted(pins)
+        assert ds.voltages.shape == (2, len(pins))
+        assert not ds.outputs.any()
+        snapshot = json.loads(ds.snapshot)
+        assert sorted(map(int, snapshot["localhost"])) == sorted(pins)